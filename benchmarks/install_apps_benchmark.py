@@ -0,0 +1,80 @@
+# Benchmark of installing apps on a host, as in the install apps phase of host_install_apps.py
+# Compares one shutil.copytree per app (how apps were installed before the file store), the file store installing one
+# app after another with shutil copies, and the file store installing apps in a thread pool with fast kernel copies
+# (reflinks or copy_file_range). Each is run twice: into an empty file store (a first deploy, where every file is
+# copied), and again into the now full store (a redeploy, where files are only linked).
+# Usage: python3 benchmarks/install_apps_benchmark.py [app count] [files per app] [temp dir]
+# The temp dir should be on the filesystem being measured, e.g. that of /var/lib on a host.
+import sys, os, time, shutil, tempfile
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "remote-scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+import file_store
+from file_store import FileStore
+from host_utils import runInPool
+
+# Files of 1KB to 64KB, like a typical node_modules, with a few larger ones
+def makeApps(appsDir, appCount, filesPerApp):
+	appPaths = []
+
+	for appNum in range(appCount):
+		appPath = f"{appsDir}/app{appNum}/release"
+
+		for fileNum in range(filesPerApp):
+			dirPath = f"{appPath}/dir{fileNum % 20}"
+			os.makedirs(dirPath, exist_ok = True)
+			size = 1024 * (1 + (fileNum * 7919) % 64) if fileNum % 100 else 1024 * 1024
+
+			with open(f"{dirPath}/file{fileNum}.js", "wb") as f:
+				f.write(os.urandom(size))
+
+		appPaths.append(appPath)
+
+	return appPaths
+
+def installWithCopytree(appPaths, destDir, storeDir):
+	for appNum, appPath in enumerate(appPaths):
+		shutil.copytree(appPath, f"{destDir}/app{appNum}")
+
+def installWithStore(appPaths, destDir, storeDir, parallel):
+	fileStore = FileStore(storeDir, storeDir + "-hashes.json")
+
+	def installApp(appNum):
+		fileStore.installTree(appPaths[appNum], f"{destDir}/app{appNum}")
+
+	if parallel:
+		runInPool(installApp, range(len(appPaths)))
+	else:
+		for appNum in range(len(appPaths)):
+			installApp(appNum)
+
+	fileStore.saveHashCache()
+
+def run(name, install, appPaths, workDir):
+	storeDir = f"{workDir}/{name}-store"
+	times = []
+
+	for runNum in range(2):
+		destDir = f"{workDir}/{name}-installed-{runNum}"
+		os.sync()
+		startTime = time.perf_counter()
+		install(appPaths, destDir, storeDir)
+		times.append(time.perf_counter() - startTime)
+
+	print(f"{name}: first deploy {times[0]:.3f}s, redeploy {times[1]:.3f}s")
+
+appCount = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+filesPerApp = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+with tempfile.TemporaryDirectory(dir = sys.argv[3] if len(sys.argv) > 3 else None) as workDir:
+	appPaths = makeApps(workDir + "/apps", appCount, filesPerApp)
+	print(f"{appCount} apps of {filesPerApp} files each")
+
+	fastCopyFile = file_store.fastCopyFile
+	file_store.fastCopyFile = shutil.copyfile
+	run("copytree", installWithCopytree, appPaths, workDir)
+	run("store-serial", lambda *args: installWithStore(*args, parallel = False), appPaths, workDir)
+
+	file_store.fastCopyFile = fastCopyFile
+	run("store-parallel", lambda *args: installWithStore(*args, parallel = True), appPaths, workDir)
@@ -0,0 +1,94 @@
+# Benchmark of generating the nginx config and systemd units for a host with many domains and app instances
+# Compares the compiled template engine against the previous one, which read the template file on every call and
+# did a str.replace over the whole text for each substitution.
+# Usage: python3 benchmarks/nginx_config_benchmark.py [domain count]
+import sys, os, time
+from pathlib import Path
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "remote-scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+import constants
+constants.HOSTSERVER_SCRIPTS_DIR = SCRIPTS_DIR
+
+import host_utils, build_nginx_config
+
+def legacyFromTemplate(templateName, substitutions):
+	template = Path(constants.HOSTSERVER_SCRIPTS_DIR + "/templates/" + templateName).read_text()
+	for original, replacement in substitutions.items():
+		template = template.replace(original, replacement)
+	return template
+
+# Every 4th domain has a web app at / and a server app at /api, the rest a server app at /, with a redirect for every
+# 10th domain. Server apps have 4 instances.
+def makeThingsByDomain(domainCount):
+	thingsByDomain = {}
+
+	for i in range(domainCount):
+		domain = f"app{i}.example.com"
+		things = {"apps" : [], "redirects" : []}
+
+		serverApp = {
+			"appName" : f"server{i}", "deploymentName" : "bench---production", "isWebApp" : False,
+			"webPath" : "/", "ports" : [9000 + i * 4 + n for n in range(4)], "releaseHash" : "0" * 64
+		}
+
+		if i % 4 == 0:
+			serverApp["webPath"] = "/api"
+			things["apps"].append({
+				"appName" : f"web{i}", "deploymentName" : "bench---production", "isWebApp" : True,
+				"webPath" : "/", "releaseHash" : "1" * 64
+			})
+
+		things["apps"].append(serverApp)
+
+		if i % 10 == 0:
+			things["redirects"].append({"domain" : domain, "regex" : "^/old/(.*)$", "destination" : "/new/$1", "code" : 301})
+
+		thingsByDomain[domain] = things
+
+	return thingsByDomain
+
+def renderUnits(fromTemplate, thingsByDomain):
+	for things in thingsByDomain.values():
+		for appInfo in things["apps"]:
+			if not appInfo["isWebApp"]:
+				for port in appInfo["ports"]:
+					fromTemplate("systemd-service.template", {
+						"###USER###" : appInfo["appName"],
+						"###PORT###" : str(port),
+						"###APP_DATA_DIR###" : "/var/lib/appcontrol/appdata/" + appInfo["appName"],
+						"###APP_LOG_DIR###" : "/var/log/appcontrol/" + appInfo["appName"],
+						"###APP_TEMP_DIR###" : "/tmp/appcontrol/" + appInfo["appName"],
+						"###ENVIRONMENT###" : host_utils.formatEnvForSystemd({"NODE_ENV" : "production"}),
+						"###WORKING_DIRECTORY###" : "/var/lib/appcontrol/installed_apps/" + appInfo["appName"],
+						"###EXEC_CMD###" : "/usr/local/bin/node server.js",
+						"###CPU_PINNING###" : "",
+						"###RESOURCE_CONTROLS###" : "",
+						"###UNIT_DEPENDENCIES###" : "",
+						"###UNIX_SOCKET###" : ""
+					})
+
+def run(name, fromTemplate, thingsByDomain):
+	build_nginx_config.fromTemplate = fromTemplate
+	host_utils.compiledTemplates.clear()
+
+	startTime = time.perf_counter()
+	includeFiles = build_nginx_config.buildNginxConf(thingsByDomain)
+	nginxTime = time.perf_counter() - startTime
+
+	startTime = time.perf_counter()
+	renderUnits(fromTemplate, thingsByDomain)
+	unitsTime = time.perf_counter() - startTime
+
+	print(f"{name}: nginx config {nginxTime:.3f}s, systemd units {unitsTime:.3f}s")
+	return includeFiles
+
+domainCount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+thingsByDomain = makeThingsByDomain(domainCount)
+instanceCount = sum(len(appInfo.get("ports", [])) for things in thingsByDomain.values() for appInfo in things["apps"])
+print(f"{domainCount} domains, {instanceCount} server app instances")
+
+legacyFiles = run("legacy", legacyFromTemplate, thingsByDomain)
+compiledFiles = run("compiled", host_utils.fromTemplate, thingsByDomain)
+assert legacyFiles == compiledFiles, "Compiled templates rendered a different config"
@@ -9,6 +9,8 @@ Path(constants.SSHD_CONFIG_PATH).write_text("""
 LoginGraceTime 20s
 MaxStartups 5:50:60
 PasswordAuthentication no
+# Control server reuses a connection for many concurrent commands and rsyncs
+MaxSessions 32
 
 # https://www.ssh-audit.com/hardening_guides.html#ubuntu_22_04_lts
 KexAlgorithms sntrup761x25519-sha512@openssh.com,curve25519-sha256,curve25519-sha256@libssh.org,gss-curve25519-sha256-,diffie-hellman-group16-sha512,gss-group16-sha512-,diffie-hellman-group18-sha512,diffie-hellman-group-exchange-sha256
@@ -1,11 +1,182 @@
+import os, re, glob, shutil, subprocess
+import constants
+from pathlib import Path
+from utils import runCommand
+from errors import NginxConfigError
 from host_utils import fromTemplate, getAppInstalledPath, getCertPrivkeyPath, getCertFullchainPath
 
-def addAppLocationBlock(appInfo, upstreamBlockNames, confUpstreamBlocks, confLocationBlocks, newInstallDir):
+# Load balancing and keepalive settings of a server app's upstream, from the upstream block of its appMeta.json
+# A server app instance listens on either a port, or a unix domain socket path
+def formatUpstreamAddress(port, host = "localhost"):
+	return "unix:" + port if isinstance(port, str) else host + ":" + str(port)
+
+def getUpstreamSettings(appInfo):
+	upstreamConfig = appInfo.get("upstream", {})
+	method = upstreamConfig.get("method", "round_robin")
+	assert method in constants.NGINX_UPSTREAM_METHODS, ("Unknown upstream method " + method + " for app " + appInfo["appName"])
+	
+	if method == "round_robin": # nginx's default
+		balancing = ""
+	elif method == "hash":
+		assert "hashKey" in upstreamConfig, ("Upstream method hash needs a hashKey, for app " + appInfo["appName"])
+		balancing = "hash " + upstreamConfig["hashKey"] + " consistent;"
+	else:
+		balancing = method + ";"
+	
+	keepalive = upstreamConfig.get("keepalive", constants.NGINX_UPSTREAM_KEEPALIVE)
+	serverParams = " max_fails=" + str(upstreamConfig.get("maxFails", 0))
+	
+	if "failTimeout" in upstreamConfig:
+		serverParams += " fail_timeout=" + str(upstreamConfig["failTimeout"])
+	
+	return balancing, ("keepalive " + str(keepalive) + ";" if keepalive > 0 else ""), serverParams
+
+# Indented, one per line, for a location block
+def formatDirectives(directives):
+	return "\n".join("\t" + directive for directive in directives)
+
+def hasNginxModule(moduleName):
+	return len(glob.glob("/etc/nginx/modules-enabled/*" + moduleName + "*")) > 0
+
+# Directives for serving a web app's files, from its appMeta.json
+# A precompressed app has .gz (and maybe .br) files alongside its files, served by nginx in place of compressing them.
+def getStaticDirectives(appInfo):
+	directives = []
+	
+	if appInfo.get("precompress"):
+		directives.append("gzip_static on;")
+		
+		# Needs the ngx_brotli module, otherwise .br files are just never served
+		if hasNginxModule("brotli"):
+			directives.append("brotli_static on;")
+	
+	if appInfo.get("openFileCache"):
+		cacheMax = appInfo["openFileCache"] if type(appInfo["openFileCache"]) is int else constants.NGINX_OPEN_FILE_CACHE_MAX
+		directives += [
+			"open_file_cache max=" + str(cacheMax) + " inactive=60s;",
+			"open_file_cache_valid 60s;",
+			"open_file_cache_errors on;"
+		]
+	
+	return formatDirectives(directives)
+
+# A web app's fingerprinted files (with a content hash in their name) never change, so may be cached forever
+# Returns the Cache-Control header directive, and adds a map of which files are fingerprinted to confHttpBlocks.
+def getCacheControl(appInfo, httpBlockNames, confHttpBlocks):
+	immutableAssets = appInfo.get("immutableAssets")
+	
+	if not immutableAssets:
+		return ""
+	
+	mapVariable = "$immutable_" + re.sub("[^0-9a-zA-Z_]", "_", appInfo["deploymentName"] + "_" + appInfo["appName"])
+	
+	if mapVariable not in httpBlockNames:
+		httpBlockNames.add(mapVariable)
+		confHttpBlocks.append(fromTemplate("nginx-webapp-cache-map.template", {
+			"###MAP_VARIABLE###" : mapVariable,
+			"###IMMUTABLE_REGEX###" : immutableAssets if isinstance(immutableAssets, str) else constants.NGINX_IMMUTABLE_ASSETS_REGEX
+		}))
+	
+	# Not sent when the variable is empty
+	return "\tadd_header Cache-Control " + mapVariable + ";"
+
+# Directives for caching a server app's responses, from the proxyCache block of its appMeta.json
+# A cache zone for the app is added to confHttpBlocks. Only GET and HEAD requests are cached, and nginx still honours
+# the app's own Cache-Control and Set-Cookie headers, so only responses the app allows to be cached are.
+def getProxyCacheDirectives(appInfo, zoneName, httpBlockNames, confHttpBlocks):
+	if not appInfo.get("proxyCache"):
+		return ""
+	
+	# Either true, for the defaults (a one second microcache), or a block of settings
+	proxyCache = {**constants.NGINX_PROXY_CACHE_DEFAULTS, **(appInfo["proxyCache"] if type(appInfo["proxyCache"]) is dict else {})}
+	
+	if "cache:" + zoneName not in httpBlockNames:
+		httpBlockNames.add("cache:" + zoneName)
+		confHttpBlocks.append(fromTemplate("nginx-serverapp-cache-path.template", {
+			"###CACHE_DIR###" : constants.NGINX_PROXY_CACHE_DIR + "/" + zoneName,
+			"###ZONE_NAME###" : zoneName,
+			"###SIZE###" : proxyCache["size"],
+			"###MAX_SIZE###" : proxyCache["maxSize"],
+			"###INACTIVE###" : proxyCache["inactive"]
+		}))
+	
+	if type(proxyCache["valid"]) is dict: # e.g. {"200 301" : "1s", "404" : "10s"}
+		validDirectives = ["proxy_cache_valid " + statuses + " " + time + ";" for statuses, time in proxyCache["valid"].items()]
+	else:
+		validDirectives = ["proxy_cache_valid " + proxyCache["valid"] + ";"]
+	
+	bypass = " ".join(proxyCache["bypass"])
+	directives = [
+		"proxy_cache " + zoneName + ";",
+		"proxy_cache_key \"" + proxyCache["key"] + "\";",
+		*validDirectives,
+		# Only one request at a time fills the cache for a key, while others wait for it or get the stale response
+		"proxy_cache_lock on;",
+		"proxy_cache_use_stale updating error timeout http_500 http_502 http_503 http_504;",
+		"proxy_cache_background_update on;",
+		"add_header X-Cache-Status $upstream_cache_status;"
+	]
+	
+	if len(bypass) > 0:
+		directives += ["proxy_cache_bypass " + bypass + ";", "proxy_no_cache " + bypass + ";"]
+	
+	return formatDirectives(directives)
+
+# Directives for a rateLimit block of an app or domain, adding its zones to confHttpBlocks
+# Locations with no limit_req of their own get the default rate limit from the nginx conf. A rateLimit of false instead
+# disables rate limiting, as any limits are only logged rather than enforced.
+def getRateLimitDirectives(rateLimit, zoneName, httpBlockNames, confHttpBlocks):
+	if rateLimit is None:
+		return []
+	
+	if rateLimit is False:
+		return ["limit_req_dry_run on;"]
+	
+	rateLimit = {**constants.NGINX_RATE_LIMIT_DEFAULTS, **rateLimit}
+	directives = []
+	
+	if "rate" in rateLimit: # e.g. "100r/s"
+		if "req-" + zoneName not in httpBlockNames:
+			httpBlockNames.add("req-" + zoneName)
+			confHttpBlocks.append(fromTemplate("nginx-limit-req-zone.template", {
+				"###KEY###" : rateLimit["key"],
+				"###ZONE_NAME###" : "req-" + zoneName,
+				"###SIZE###" : rateLimit["size"],
+				"###RATE###" : rateLimit["rate"]
+			}))
+		
+		directives.append(
+			"limit_req zone=req-" + zoneName + " burst=" + str(rateLimit["burst"]) + (" nodelay" if rateLimit["nodelay"] else "") + ";"
+		)
+	
+	if "connections" in rateLimit: # max connections at once, per key
+		if "conn-" + zoneName not in httpBlockNames:
+			httpBlockNames.add("conn-" + zoneName)
+			confHttpBlocks.append(fromTemplate("nginx-limit-conn-zone.template", {
+				"###KEY###" : rateLimit["key"],
+				"###ZONE_NAME###" : "conn-" + zoneName,
+				"###SIZE###" : rateLimit["size"]
+			}))
+		
+		directives.append("limit_conn conn-" + zoneName + " " + str(rateLimit["connections"]) + ";")
+	
+	return directives
+
+# domainRateLimits are the rate limit directives of the domain, which apply to all of its apps along with their own
+def addAppLocationBlock(appInfo, httpBlockNames, confHttpBlocks, confLocationBlocks, domainRateLimits):
+	appZoneName = "app-" + appInfo["deploymentName"] + "-" + appInfo["appName"]
+	rateLimits = formatDirectives(
+		domainRateLimits + getRateLimitDirectives(appInfo.get("rateLimit"), appZoneName, httpBlockNames, confHttpBlocks)
+	)
+	
 	if appInfo["isWebApp"]:
 		# For other than the default, root, web app, add a location block
 		confLocationBlocks.append(fromTemplate("nginx-webapp-location.template", {
 			"###WEBPATH###" : appInfo["webPath"].strip("/"), # conf already has slashes
-			"###ROOT_DIR###" : getAppInstalledPath(newInstallDir, appInfo)
+			"###ROOT_DIR###" : getAppInstalledPath(appInfo),
+			"###STATIC_DIRECTIVES###" : getStaticDirectives(appInfo),
+			"###CACHE_CONTROL###" : getCacheControl(appInfo, httpBlockNames, confHttpBlocks),
+			"###RATE_LIMITS###" : rateLimits
 		}))
 	else: # Server app
 		# Create an upstream block
@@ -14,32 +185,47 @@ def addAppLocationBlock(appInfo, upstreamBlockNames, confUpstreamBlocks, confLoc
 		# ensure only one upstream block for this given deployment/app combination
 		# this is required as an app location block can appear in multiple domain names on the same server
 		# but we must only have one upstream for all of these
-		if upstreamName not in upstreamBlockNames:
-			upstreamBlockNames.add(upstreamName)
+		if upstreamName not in httpBlockNames:
+			httpBlockNames.add(upstreamName)
 			
-			# Default to just one instance in total if "instancesPerCPU" is set to zero (the default)
-			# Otherwise... an instance per CPU!
-			instanceCount = appInfo["instanceCount"]
-
-			confUpstreamBlocks.append(fromTemplate("nginx-serverapp-upstream.template", {
+			# One server per instance. Ports are not necessarily contiguous, as unchanged instances keep their port.
+			# Instances that didn't become ready are left out after a single failed request, and tried again after a while
+			# (rather than marked down, so that they're used once they do become ready), unless none are ready.
+			notReadyPorts = appInfo.get("notReadyPorts", set())
+			allNotReady = all(port in notReadyPorts for port in appInfo["ports"])
+			balancing, keepalive, serverParams = getUpstreamSettings(appInfo)
+			notReadyParams = " max_fails=1 fail_timeout=" + constants.NGINX_NOT_READY_FAIL_TIMEOUT
+			# The socket of a socket activated instance only listens on IPv4 loopback, which localhost may not only be
+			upstreamHost = constants.SOCKET_LISTEN_ADDRESS if appInfo.get("socketActivation") else "localhost"
+			
+			confHttpBlocks.append(fromTemplate("nginx-serverapp-upstream.template", {
 				"###UPSTREAM_NAME###" : upstreamName,
-				"###SERVERS###" : "\n"
-					.join(["server localhost:" + str(appInfo["portRangeStart"] + i) + " max_fails=0;" for i in range(0, instanceCount)])
+				"###BALANCING###" : balancing,
+				"###SERVERS###" : "\n".join([
+					"server " + formatUpstreamAddress(port, upstreamHost) + (notReadyParams if port in notReadyPorts and not allNotReady else serverParams) + ";"
+					for port in appInfo["ports"]
+				]),
+				"###KEEPALIVE###" : keepalive
 			}))
 
 		# Create a location block
 		# Have to use a different template for root and non root webPath due to nginx quirks
 		
 		webPath = appInfo["webPath"].strip("/") # conf already has slashes
+		proxyCache = getProxyCacheDirectives(appInfo, upstreamName, httpBlockNames, confHttpBlocks)
 		
 		if len(webPath) > 0: # Not root
 			confLocationBlocks.append(fromTemplate("nginx-serverapp-location.template", {
 				"###WEBPATH###" : webPath,
-				"###UPSTREAM_NAME###" : upstreamName
+				"###UPSTREAM_NAME###" : upstreamName,
+				"###PROXY_CACHE###" : proxyCache,
+				"###RATE_LIMITS###" : rateLimits
 			}))
 		else:
 			confLocationBlocks.append(fromTemplate("nginx-serverapp-root-location.template", {
-				"###UPSTREAM_NAME###" : upstreamName
+				"###UPSTREAM_NAME###" : upstreamName,
+				"###PROXY_CACHE###" : proxyCache,
+				"###RATE_LIMITS###" : rateLimits
 			}))
 
 
@@ -57,10 +243,12 @@ def addRedirectLocationBlock(redirectInfo, confLocationBlocks):
 		}))
 
 
-def buildNginxConf(newInstallDir, thingsByDomain, letsencryptThumbprint):
-	confServerBlocks = []
-	confUpstreamBlocks = []
-	upstreamBlockNames = set()
+# Returns the files to be included by the main nginx conf, keyed by file name
+# Each domain's server block has its own file, so that only domains that changed need rewriting.
+def buildNginxConf(thingsByDomain):
+	includeFiles = {}
+	confHttpBlocks = []
+	httpBlockNames = set()
 
 	# Add a server block for each domain name
 	# Each may in turn contain several apps
@@ -71,35 +259,134 @@ def buildNginxConf(newInstallDir, thingsByDomain, letsencryptThumbprint):
 		rootApp = None
 		defaultRoot = "/var/www/html"
 		confLocationBlocks = []
+		domainRateLimits = getRateLimitDirectives(things.get("rateLimit"), "domain-" + domain, httpBlockNames, confHttpBlocks)
 
 		for appInfo in appInfos: # For each app of this domain
 			# There is a top level, root, app
 			if appInfo["webPath"] == "/":
 				rootApp = appInfo
 			else:
-				addAppLocationBlock(appInfo, upstreamBlockNames, confUpstreamBlocks, confLocationBlocks, newInstallDir)
+				addAppLocationBlock(appInfo, httpBlockNames, confHttpBlocks, confLocationBlocks, domainRateLimits)
 		
 		for redirectInfo in redirectInfos:
 			addRedirectLocationBlock(redirectInfo, confLocationBlocks)
 		
 		# Add the root app last, so its regex location is matched last if other matches fail
 		if rootApp:
-			addAppLocationBlock(rootApp, upstreamBlockNames, confUpstreamBlocks, confLocationBlocks, newInstallDir)
+			addAppLocationBlock(rootApp, httpBlockNames, confHttpBlocks, confLocationBlocks, domainRateLimits)
 			
 			# Only add web root for a web app
 			if appInfo["isWebApp"]:
-				defaultRoot = getAppInstalledPath(newInstallDir, rootApp)
+				defaultRoot = getAppInstalledPath(rootApp)
 
-		confServerBlocks.append(fromTemplate("nginx-server-block.template", {
+		includeFiles[domain + ".conf"] = fromTemplate("nginx-server-block.template", {
 			"###SSL_CERT_FULLCHAIN###" : "/root/" + getCertFullchainPath(domain),
 			"###SSL_CERT_KEY###" : "/root/" + getCertPrivkeyPath(domain),
 			"###DEFAULT_ROOT###" : defaultRoot,
 			"###DOMAIN_NAME###" : domain,
 			"###APP_LOCATION_BLOCKS###" : "\n".join(confLocationBlocks)
-		}))
+		})
+
+	includeFiles[constants.NGINX_HTTP_FILE] = "\n".join(confHttpBlocks)
+	return includeFiles
 
+def buildMainNginxConf(letsencryptThumbprint, includeDir):
 	return fromTemplate("nginx-conf.template", {
-		"###APP_UPSTREAM_BLOCKS###" : "\n".join(confUpstreamBlocks),
 		"###LETSENCRYPT_ACCOUNT_THUMBPRINT###" : letsencryptThumbprint,
-		"###SERVER_BLOCKS###" : "\n".join(confServerBlocks)
+		"###INCLUDE_DIR###" : includeDir
 	})
+
+def readFileIfExists(filePath):
+	try:
+		return Path(filePath).read_text()
+	except FileNotFoundError:
+		return None
+
+def replaceFile(filePath, content):
+	Path(filePath + ".tmp").write_text(content)
+	os.replace(filePath + ".tmp", filePath)
+
+# Prepare the nginx config, given the include files from buildNginxConf, without touching anything live
+# Only files that changed are written, to a candidate copy of the entire new config (with links to the unchanged live
+# files) which is then tested with nginx -t. Raises NginxConfigError if it fails. Returns the candidate to pass to
+# installNginxConf, or None if nothing changed and so nginx needn't be reloaded.
+def prepareNginxConf(includeFiles, letsencryptThumbprint):
+	os.makedirs(constants.NGINX_INCLUDE_DIR, exist_ok = True)
+	mainConf = buildMainNginxConf(letsencryptThumbprint, constants.NGINX_INCLUDE_DIR)
+	
+	changedFiles = [
+		fileName for fileName, content in includeFiles.items()
+		if readFileIfExists(constants.NGINX_INCLUDE_DIR + "/" + fileName) != content
+	]
+	
+	deletedFiles = [
+		fileName for fileName in os.listdir(constants.NGINX_INCLUDE_DIR)
+		if fileName.endswith(".conf") and fileName not in includeFiles
+	]
+	
+	mainConfChanged = readFileIfExists(constants.NGINX_CONF_PATH) != mainConf
+	
+	if len(changedFiles) == 0 and len(deletedFiles) == 0 and not mainConfChanged:
+		return None
+	
+	# nginx only creates the last dir of a proxy_cache_path, which nginx -t fails without
+	os.makedirs(constants.NGINX_PROXY_CACHE_DIR, exist_ok = True)
+	shutil.chown(constants.NGINX_PROXY_CACHE_DIR, constants.NGINX_USER, constants.NGINX_USER)
+	
+	candidateIncludeDir = constants.NGINX_CANDIDATE_DIR + "/include"
+	candidateConfPath = constants.NGINX_CANDIDATE_DIR + "/nginx.conf"
+	shutil.rmtree(constants.NGINX_CANDIDATE_DIR, ignore_errors = True)
+	os.makedirs(candidateIncludeDir)
+	
+	try:
+		for fileName, content in includeFiles.items():
+			if fileName in changedFiles:
+				Path(candidateIncludeDir + "/" + fileName).write_text(content)
+			else:
+				os.link(constants.NGINX_INCLUDE_DIR + "/" + fileName, candidateIncludeDir + "/" + fileName)
+		
+		Path(candidateConfPath).write_text(buildMainNginxConf(letsencryptThumbprint, candidateIncludeDir))
+		
+		try:
+			runCommand(["nginx", "-t", "-q", "-c", candidateConfPath])
+		except subprocess.CalledProcessError as error:
+			raise NginxConfigError(error.stderr.decode().strip())
+	except:
+		shutil.rmtree(constants.NGINX_CANDIDATE_DIR, ignore_errors = True)
+		raise
+	
+	return {
+		"includeFiles" : includeFiles,
+		"changedFiles" : changedFiles,
+		"deletedFiles" : deletedFiles,
+		"mainConf" : mainConf if mainConfChanged else None
+	}
+
+# Install a candidate from prepareNginxConf, which has passed nginx -t, swapping in each changed file atomically
+def installNginxConf(candidate):
+	candidateIncludeDir = constants.NGINX_CANDIDATE_DIR + "/include"
+	
+	print(f"nginx config has {len(candidate['changedFiles'])} changed and {len(candidate['deletedFiles'])} removed files")
+	
+	try:
+		for fileName in candidate["changedFiles"]:
+			os.replace(candidateIncludeDir + "/" + fileName, constants.NGINX_INCLUDE_DIR + "/" + fileName)
+		
+		for fileName in candidate["deletedFiles"]:
+			os.remove(constants.NGINX_INCLUDE_DIR + "/" + fileName)
+		
+		if candidate["mainConf"] is not None:
+			replaceFile(constants.NGINX_CONF_PATH, candidate["mainConf"])
+	finally:
+		shutil.rmtree(constants.NGINX_CANDIDATE_DIR, ignore_errors = True)
+
+# Remove the cache dirs of apps that no longer have a proxyCache, given the include files from buildNginxConf
+def purgeProxyCacheDirs(includeFiles):
+	if not os.path.isdir(constants.NGINX_PROXY_CACHE_DIR):
+		return
+	
+	cacheDirs = set(re.findall(r"^proxy_cache_path (\S+)", includeFiles[constants.NGINX_HTTP_FILE], re.MULTILINE))
+	
+	for dirent in os.scandir(constants.NGINX_PROXY_CACHE_DIR):
+		if dirent.path not in cacheDirs:
+			shutil.rmtree(dirent.path, ignore_errors = True)
@@ -8,6 +8,11 @@ CONTROLSERVER_DEPLOYMENTS_DIR = "appcontrol-master-deployments"
 CONTROLSERVER_DEPLOYMENTS_INCOMING_DIR = "appcontrol-master-deployments-incoming"
 CONTROLSERVER_CERTS_DIR = "appcontrol-master-certs"
 CONTROLSERVER_CONF_PATH = "appcontrol-master.conf.json"
+CONTROLSERVER_INJECT_CACHE_DIR = "appcontrol-master-inject-cache"
+CONTROLSERVER_MANIFESTS_DIR = "appcontrol-master-manifests"
+CONTROLSERVER_DEPLOY_REPORTS_DIR = "appcontrol-master-deploy-reports"
+CONTROLSERVER_PRECOMPRESS_CACHE_DIR = "appcontrol-master-precompress-cache"
+CONTROLSERVER_STAGING_DIR = "appcontrol-master-staging" # temp dirs of deploys, on the same filesystem as the deployments
 
 # on non master, "host", servers
 HOSTSERVER_SCRIPTS_DIR = "appcontrol-host-scripts"
@@ -15,6 +20,9 @@ HOSTSERVER_APPS_DIR = "appcontrol-host-apps"
 HOSTSERVER_CERTS_DIR = "appcontrol-host-certs"
 HOSTSERVER_CONF_PATH = "appcontrol-host.conf.json"
 HOSTSERVER_INSTALLED_APPS_DIR = "/var/lib/" + TOOL_NAME_LOWERCASE + "/installed_apps"
+HOSTSERVER_FILE_STORE_DIR = "/var/lib/" + TOOL_NAME_LOWERCASE + "/filestore" # must be on same filesystem as installed apps
+HOSTSERVER_FILE_HASH_CACHE_PATH = "appcontrol-host-file-hashes.json"
+HOSTSERVER_MANIFEST_HASH_CACHE_DIR = "appcontrol-host-manifest-hashes"
 HOSTSERVER_APP_DATA_DIR = "/var/lib/" + TOOL_NAME_LOWERCASE + "/appdata"
 HOSTSERVER_APP_LOG_DIR = "/var/log/" + TOOL_NAME_LOWERCASE
 HOSTSERVER_APP_TEMP_DIR = "/tmp/" + TOOL_NAME_LOWERCASE
@@ -29,9 +37,74 @@ REMOTE_EXIT_CODE_HOST_VERIFICATION_FAILED = 4
 CONTROL_KEY_NAME = "control-key"
 KNOWN_HOSTS_PATH = ".ssh/known_hosts"
 SERVERAPP_PORT_START = 9000
+SOCKET_PORT_START = 20000 # stable ports of socket activated server app instances are allocated from here
+SOCKET_PORT_END = 30000 # up to here, and other server app instances' ports must stay below SOCKET_PORT_START
+SOCKET_LISTEN_ADDRESS = "127.0.0.1" # sockets of socket activated instances only accept connections from this host
+UNIX_SOCKET_PATH_MAX = 107 # bytes, the most a unix domain socket's path can be
+NGINX_USER = "www-data" # which must be able to connect to server apps' unix domain sockets
+SOCKET_BACKLOG = 4096 # connections queued by a socket activated instance's socket, e.g. while it restarts
+HOST_INSTALL_CONCURRENCY = 8 # max apps installed at once on a host
+SYSTEMCTL_BATCH_SIZE = 500 # max units per systemctl command line
+SYSTEMD_RESOURCE_CONTROLS = { # resources keys of an app, and the systemd settings they set in each instance's unit
+	"memoryMax" : "MemoryMax",
+	"memoryHigh" : "MemoryHigh",
+	"cpuQuota" : "CPUQuota",
+	"cpuWeight" : "CPUWeight",
+	"ioWeight" : "IOWeight",
+	"tasksMax" : "TasksMax",
+	"limitNOFILE" : "LimitNOFILE"
+}
+SERVICE_SLOTS = ["", "---green"] # service name suffixes of the two blue/green slots
+READY_TIMEOUT = 60 # default seconds for restarted services to be ready, before blue/green apps are rolled back
+PROBE_ATTEMPT_TIMEOUT = 2 # seconds, for a single readiness probe of a service
+PROBE_INTERVAL = 0.25 # seconds between readiness probes of a service that isn't ready yet
+PROBE_CONCURRENCY = 256 # max readiness probes at once
+PROBE_SLOW_AFTER = 10 # seconds, a service taking longer than this to be ready is reported as slow
+BLUE_GREEN_DRAIN_DELAY = 5 # seconds replaced services keep running after nginx has switched away from them
 NGINX_CONF_PATH = "/etc/nginx/nginx.conf"
 NGINX_CONF_MAGIC = "---APPCONTROL_MAGIC_IDENT---"
+NGINX_INCLUDE_DIR = "/etc/nginx/" + TOOL_NAME_LOWERCASE # included by the nginx conf
+NGINX_CANDIDATE_DIR = "/etc/nginx/" + TOOL_NAME_LOWERCASE + "-candidate" # new config is tested here before it's used
+NGINX_HTTP_FILE = "_http.conf" # upstreams and other http level blocks, in the include dir along with a file for each domain
+NGINX_UPSTREAM_KEEPALIVE = 32 # default idle connections kept open to each server app, per nginx worker
+NGINX_NOT_READY_FAIL_TIMEOUT = "10s" # how long nginx leaves out an instance that wasn't ready, before trying it again
+NGINX_IMMUTABLE_ASSETS_REGEX = "(^|/)(static|assets)/.+[.-][0-9a-zA-Z_-]{8,}\\.[0-9a-z]+$" # fingerprinted web app files
+NGINX_OPEN_FILE_CACHE_MAX = 10000 # default max open file descriptors and file lookups cached, per nginx worker
+NGINX_PROXY_CACHE_DIR = "/var/cache/nginx/" + TOOL_NAME_LOWERCASE # a subdir for each server app with a proxyCache
+NGINX_PROXY_CACHE_DEFAULTS = { # for any keys omitted from a server app's proxyCache
+	"size" : "10m", # of the shared memory zone of cache keys, about 8000 keys per megabyte
+	"maxSize" : "1g",
+	"inactive" : "10m", # unused responses are removed after this, even if still valid
+	"valid" : "1s", # how long responses are cached, for 200, 301 and 302 when not an object of status codes to times
+	"key" : "$scheme$host$request_uri",
+	"bypass" : ["$http_authorization", "$http_cookie"] # requests where any of these are non empty (and not "0") skip the cache
+}
+NGINX_RATE_LIMIT_DEFAULTS = { # for any keys omitted from an app's or domain's rateLimit
+	"key" : "$binary_remote_addr", # requests are limited per client address
+	"size" : "10m", # of each shared memory zone, about 160000 keys per megabyte
+	"burst" : 10, # requests over the rate that are allowed before any are rejected
+	"nodelay" : True # requests within the burst are passed on immediately, rather than delayed to fit the rate
+}
+NGINX_UPSTREAM_METHODS = ["round_robin", "least_conn", "ip_hash", "hash", "random"] # load balancing methods
+MANIFEST_FILE = "manifest.json" # manifest of a deployment's apps, sent to hosts along with them
 LOCAL_CONFIG_FILE = "appcontrol.json" # Ideally this should be copied acrosss from constants.js! (is repeated from there)
 ACME_SH_PATH = "/root/.acme.sh/acme.sh"
+CERT_ISSUE_CONCURRENCY = 4 # default max certs issued at once
+INJECT_CACHE_MAX_AGE = 30 * 24 * 3600 # seconds an unused env injection cache entry is kept
+PRECOMPRESS_REGEX = "\\.(html?|css|m?js|json|map|svg|txt|xml|wasm|ico|ttf|otf|eot)$" # web app files precompressed by default
+PRECOMPRESS_MIN_SIZE = 1024 # bytes, smaller files aren't worth compressing
+PRECOMPRESS_CACHE_MAX_AGE = 30 * 24 * 3600 # seconds an unused precompressed file is kept in the cache
 SSHD_CONFIG_PATH = "/etc/ssh/sshd_config.d/appcontrol.conf"
 HOST_VERIFICATION_MATCH_STR = "Host key verification failed"
+SSH_KEEPALIVE_INTERVAL = 30
+SSH_CONTROL_PATH_PREFIX = "~/.ssh/" + TOOL_NAME_LOWERCASE + "-cm-" # rsync's multiplexed ssh connections
+SSH_CONTROL_PERSIST = 60 # seconds an idle multiplexed ssh connection stays open
+HOST_OPERATIONS_CONCURRENCY = 64 # default max ssh commands and rsyncs running at once, across all hosts
+HOST_OPERATIONS_PER_HOST_CONCURRENCY = 4 # and to any one host
+HOST_OPERATION_ATTEMPTS = 6 # before an ssh command or rsync is given up on
+HOST_OPERATION_TIMEOUT = 30 * 60 # seconds, for a single attempt
+HOST_OPERATION_BACKOFF_BASE = 2 # seconds, doubled after each failed attempt
+HOST_OPERATION_BACKOFF_MAX = 60
+DEPLOY_TIMEOUT = 2 * 3600 # seconds, after which no more host operations are started
+REMOTE_REPORT_PREFIX = "###APPCONTROL_REPORT###" # marks a report line in the output of a host script
+DEPLOY_REPORTS_KEPT = 50 # per deployment
@@ -1,19 +1,23 @@
-import sys, json, asyncio, os, tempfile, shutil, re, subprocess
-from pathlib import Path
+import sys, json, asyncio, os, tempfile, shutil, subprocess, hashlib
 import constants
 from utils import ConfigStore
-from errors import HostVerificationError
+from errors import HostVerificationError, HostOperationError
+from inject_env import fileInjectEnv, pruneInjectEnvCache
+from precompress import precompressFiles, prunePrecompressCache
+from deploy_report import DeployReport
+from host_scheduler import hostScheduler
 
 # A place to store some local state for control server
 localConf = ConfigStore(constants.CONTROLSERVER_CONF_PATH)
 # Check this before we import anything that uses non-standard modules (i.e. parallel-ssh)
 assert localConf.get("initialised") != None, "Control server was not correctly initialised. Perhaps the reset command needs to be called."
 
-from utils import getProjectNameAndTarget, rsync, getDeploymentKey, runCommand, localRsync
+from utils import getProjectNameAndTarget, rsync, getDeploymentKey, runCommand, runCommandAsync, localSync, FileHashCache, linkOrCopyFile
 from control_utils import (
 	readDeployConfig, serversFromDeployConfig, getCertPrivkeyPath, getCertFullchainPath,
 	getAllDomains, getDomainsInServer, runOnAllHosts, writeKnownHosts, getServersByHost, readServers,
-	readServersIncoming, getAllDeployments, hostsFromServers, hostFromServer
+	readServersIncoming, getAllDeployments, hostsFromServers, hostFromServer, closeHostConnections, rsyncCerts,
+	syncAppsToHost, splitIntoWaves, runCommandOnAllHosts, getHostScriptCommand
 )
 
 email = sys.argv[1]
@@ -29,6 +33,9 @@ print(f"Deployment name: {deploymentName}")
 print(f"Project name: {projectName}")
 print(f"Deploy target: {deployTarget}")
 
+# Timing of each phase of this deploy, saved once it finishes
+report = DeployReport()
+
 # Update letsencrypt account email if it has changed
 if email != localConf.get("email"):
 	print("Email changed from " + str(localConf.get("email")) + " to " + email + ", setting new letsencrypt email...")
@@ -85,13 +92,21 @@ def checkForWebPathConflicts():
 			
 			domainAndWebPathSet.add(hash)
 
-checkForWebPathConflicts()
+with report.span("check web paths"):
+	checkForWebPathConflicts()
+
+# Hashes of this deployment's files, in the incoming, deployment and staging dirs, kept across deploys
+hashCache = FileHashCache(constants.CONTROLSERVER_MANIFESTS_DIR + "/" + deploymentName + "/hashes.json")
 
 # Move incoming deployment to the *actual* deployment dir, now that some stuff above was validated
-localRsync(
-	constants.CONTROLSERVER_DEPLOYMENTS_INCOMING_DIR + "/" + deploymentName + "/",
-	constants.CONTROLSERVER_DEPLOYMENTS_DIR + "/" + deploymentName,
-)
+with report.span("sync incoming deployment"):
+	changed, deleted = localSync(
+		constants.CONTROLSERVER_DEPLOYMENTS_INCOMING_DIR + "/" + deploymentName,
+		constants.CONTROLSERVER_DEPLOYMENTS_DIR + "/" + deploymentName,
+		hashCache
+	)
+
+print(f"Updated deployment with {len(changed)} changed and {len(deleted)} deleted files")
 
 # Must deploy scripts (from working directory) to all other servers in this deploy target (to their local ~/appcontrol dir)
 # First, get the host IPs
@@ -105,13 +120,17 @@ if "letsencrypt" in targetConfig: # letsencrypt config in the target block has p
 elif "letsencrypt" in deployConfig: # use the global config if present
 	letsencryptConfig = deployConfig["letsencrypt"]
 
+# Limits, retries and timeouts of ssh commands and rsyncs to hosts, and the deadline of this deploy
+hostScheduler.configureFromConfig(targetConfig.get("hostOperations", {}))
+
 servers = serversFromDeployConfig(deploymentName, deployConfig)
 hosts = hostsFromServers(servers)
 
 print(f"Deploying to hosts: {hosts}")
 
 # Write correct host fingerprints to known_hosts, for *all* deployments on this control server
-writeKnownHosts()
+with report.span("write known hosts"):
+	writeKnownHosts()
 
 # Issue all necessary SSL certs here on control server (get set of all domains from deployment)
 # Get all domains for this deployment
@@ -120,58 +139,66 @@ domainSet = getAllDomains(servers)
 
 print(f"All domains in this deployment: {domainSet}")
 
-def issueCertsDNS(domainSet):
-	dnsHookName = letsencryptConfig["dns_hook"]
-	challengeAliasDomain = letsencryptConfig.get("challenge_alias_domain") # Can be omitted, so will be None
-
-	acmeShIssueCommand = [constants.ACME_SH_PATH, "--issue", "--dns", dnsHookName]
-
-	if challengeAliasDomain:
-		acmeShIssueCommand.extend(["--challenge-alias", challengeAliasDomain])
-
-	for domain in domainSet:
-		# Issue cert for each domain separately
-		acmeShIssueCommandForThisDomain = acmeShIssueCommand + ["-d", domain]
-
-		print(acmeShIssueCommandForThisDomain)
-		print(runCommand(acmeShIssueCommandForThisDomain, letsencryptConfig["env"]))
-
-		# Install the certs to appcontrol-master-certs dir
-		print(runCommand([
-			constants.ACME_SH_PATH, "--install-cert", "-d", domain,
-			"--key-file", getCertPrivkeyPath(domain),
-			"--fullchain-file", getCertFullchainPath(domain)
-		]))
-
-def issueCertsHTTP(domainSet):
-	acmeShIssueCommand = [constants.ACME_SH_PATH, "--issue", "--stateless"]
-	
-	for domain in domainSet:
-		# Issue cert for each domain separately
-		acmeShIssueCommandForThisDomain = acmeShIssueCommand + ["-d", domain]
-
-		print(acmeShIssueCommandForThisDomain)
-		print(runCommand(acmeShIssueCommandForThisDomain))
-
-		# Install the certs to appcontrol-master-certs dir
-		print(runCommand([
-			constants.ACME_SH_PATH, "--install-cert", "-d", domain,
-			"--key-file", getCertPrivkeyPath(domain),
-			"--fullchain-file", getCertFullchainPath(domain)
-		]))
-
-def issueCerts(domainSet):
-	try:
-		if letsencryptConfig and "dns_hook" in letsencryptConfig:
-			issueCertsDNS(domainSet)
-		else:
-			issueCertsHTTP(domainSet) # http is default if no config given
-	except subprocess.CalledProcessError as error:
-		if error.returncode == 1:
-			print("Certificate request failed!")
-			sys.exit(constants.REMOTE_EXIT_CODE_CERT_FAILED)
-		else:
-			raise error
+# Returns the acme.sh issue command (without domain) and any env it needs
+def getAcmeShIssueCommand():
+	if letsencryptConfig and "dns_hook" in letsencryptConfig:
+		dnsHookName = letsencryptConfig["dns_hook"]
+		challengeAliasDomain = letsencryptConfig.get("challenge_alias_domain") # Can be omitted, so will be None
+
+		acmeShIssueCommand = [constants.ACME_SH_PATH, "--issue", "--dns", dnsHookName]
+
+		if challengeAliasDomain:
+			acmeShIssueCommand.extend(["--challenge-alias", challengeAliasDomain])
+
+		return acmeShIssueCommand, letsencryptConfig["env"]
+	else:
+		return [constants.ACME_SH_PATH, "--issue", "--stateless"], None # http is default if no config given
+
+# Issue and install the cert for a single domain, returning whether it succeeded
+async def issueCert(domain, acmeShIssueCommand, acmeShEnv, semaphore):
+	async with semaphore:
+		with report.span("issue cert", detail = domain):
+			# Issue cert for each domain separately
+			acmeShIssueCommandForThisDomain = acmeShIssueCommand + ["-d", domain]
+			print(acmeShIssueCommandForThisDomain)
+
+			try:
+				print(await runCommandAsync(acmeShIssueCommandForThisDomain, acmeShEnv))
+			except subprocess.CalledProcessError as error:
+				# 2 means acme.sh already has a valid cert for this domain, which just needs installing
+				if error.returncode != 2:
+					print(f"Certificate request for {domain} failed with code {error.returncode}")
+					return False
+
+			try:
+				# Install the certs to appcontrol-master-certs dir
+				print(await runCommandAsync([
+					constants.ACME_SH_PATH, "--install-cert", "-d", domain,
+					"--key-file", getCertPrivkeyPath(domain),
+					"--fullchain-file", getCertFullchainPath(domain)
+				]))
+			except subprocess.CalledProcessError as error:
+				print(f"Certificate install for {domain} failed with code {error.returncode}")
+				return False
+
+			print(f"Certificate for {domain} issued and installed")
+			return True
+
+# Issue certs for several domains at once, limited to a configurable number at a time to stay well within
+# letsencrypt's rate limits. Any domains that succeed are installed even if others fail.
+async def issueCerts(domains):
+	concurrency = letsencryptConfig.get("concurrency", constants.CERT_ISSUE_CONCURRENCY) if letsencryptConfig else constants.CERT_ISSUE_CONCURRENCY
+	semaphore = asyncio.Semaphore(concurrency)
+	acmeShIssueCommand, acmeShEnv = getAcmeShIssueCommand()
+
+	results = await asyncio.gather(*[issueCert(domain, acmeShIssueCommand, acmeShEnv, semaphore) for domain in domains])
+	failedDomains = [domain for domain, succeeded in zip(domains, results) if not succeeded]
+
+	print(f"Issued certs for {len(domains) - len(failedDomains)} of {len(domains)} domains")
+
+	if len(failedDomains) > 0:
+		print("Certificate request failed for the following domains", str(failedDomains))
+		sys.exit(constants.REMOTE_EXIT_CODE_CERT_FAILED)
 
 async def main():
 	try:
@@ -183,54 +210,46 @@ async def main():
 
 		if len(domainsWithoutCerts) > 0:
 			print("Issuing certs for the following domains", str(domainsWithoutCerts))
-			issueCerts(domainsWithoutCerts)
+			await issueCerts(domainsWithoutCerts)
 		
 		await deploy()
 	except HostVerificationError as error:
 		print(error)
 		sys.exit(constants.REMOTE_EXIT_CODE_HOST_VERIFICATION_FAILED)
+	except HostOperationError as error:
+		print(error)
+		sys.exit(constants.REMOTE_EXIT_CODE_HOST_COMMAND_FAILED)
+	finally:
+		await closeHostConnections()
+		hostScheduler.printResults()
+		printProbeSummary()
+		
+		for host, result in hostScheduler.results.items():
+			report.addHostReport(host, {"operations" : result})
+		
+		# Saved even if the deploy failed, as it shows how far it got
+		report.save(constants.CONTROLSERVER_DEPLOY_REPORTS_DIR + "/" + deploymentName)
+		report.printSummary()
+
+# Server app instances on any host that didn't become ready after being restarted, or were slow to
+def printProbeSummary():
+	for host, hostReport in sorted(report.hostReports.items()):
+		for serviceName, result in sorted(hostReport.get("probes", {}).items()):
+			if not result["ready"]:
+				print(f"{host}: {serviceName} is not ready ({result['error']})")
+			elif result["slow"]:
+				print(f"{host}: {serviceName} was slow to start, taking {result['latency']:.1f}s")
 
 async def initHosts():
 	# Sync all the control scripts to *all* hosts
 	await asyncio.gather(*[
-		rsync(host, getDeploymentKey(deploymentName), constants.CONTROLSERVER_SCRIPTS_DIR + "/", constants.HOSTSERVER_SCRIPTS_DIR) for host in hosts
+		report.timeAsync("sync scripts", rsync(
+			host, getDeploymentKey(deploymentName), constants.CONTROLSERVER_SCRIPTS_DIR + "/", constants.HOSTSERVER_SCRIPTS_DIR
+		), host) for host in hosts
 	])
 	
 	# Run server-init.py on each. Creates some necessary dirs and installs some stuff if not already installed
-	await runOnAllHosts(hosts, deploymentName, "host_init.py " + deploymentName + " " + localConf.get("letsencryptThumbprint"))
-
-def fileInjectEnv(dirPath, testRegex, env):
-	for dirent in os.scandir(dirPath):
-		if dirent.is_dir():
-			# Recurse
-			fileInjectEnv(dirent.path, testRegex, env)
-		elif dirent.is_file():
-			# Replace?
-			if re.search(testRegex, dirent.name):
-				fileContents = Path(dirent.path).read_text()
-				
-				# substitute within fileContents
-				# first find all diff env vars that are used in the file
-				# then, replace them
-
-				for envVar, envVal in env.items():
-					envPlaceholderStr = "###APPCONTROL_ENV_{}###".format(envVar)
-					
-					if envPlaceholderStr in fileContents:
-						# This env was used. Replace the placeholder with the env var's value!
-						fileContents = fileContents.replace(envPlaceholderStr, envVal)
-
-				# also may inject entire env as JSON
-				fileContents = fileContents.replace("###APPCONTROL_JSON_ENV###", json.dumps(env))
-
-				# Finally, check for any remaining ###APPCONTROL_*###, giving a warning if encountered
-				# (an env var probably should have been set)
-				if "###APPCONTROL_" in fileContents:
-					print("Warning: Some ###APPCONTROL template strings were not matched with environmental variables and will remain in deployed app!")
-					print(["###APPCONTROL_{}###".format(x) for x in re.findall("###APPCONTROL_(.+)###", fileContents)])
-				
-				Path(dirent.path).write_text(fileContents)
-
+	await runOnAllHosts(hosts, deploymentName, "host_init.py " + deploymentName + " " + localConf.get("letsencryptThumbprint"), report)
 
 def overloadAppEnvFromConfig(env, config, appName, isWebApp):
 	if "env" in config: # start with global env that applies to all apps
@@ -254,94 +273,193 @@ def overloadAppEnvFromConfig(env, config, appName, isWebApp):
 		env.update(config["envApp"][appName])
 
 
+# Get the appMeta.json of an app as it will be deployed for a given app block of a server
+def getDeployedAppMeta(appInfo):
+	appName = appInfo["app"]
+
+	# Inject some stuff that's needed by the host server into the app's appMeta.json
+	with open(constants.CONTROLSERVER_DEPLOYMENTS_DIR + "/" + deploymentName + "/apps/" + appName + "/appMeta.json", "r") as fp:
+		appMeta = json.load(fp)
+		appMeta["appName"] = appName
+		appMeta["deploymentName"] = deploymentName
+
+		# Copy certain keys from appInfo/config only if set
+		for keyName in ["domains", "webPath", "instancesPerCPU", "instances", "maxInstances", "cpuAffinity", "resources", "dataGroup", "blueGreen", "socketActivation", "unixSocket", "upstream", "proxyCache", "rateLimit", "precompress", "immutableAssets", "openFileCache"]:
+			if keyName in appInfo:
+				appMeta[keyName] = appInfo[keyName]
+		
+		# Or for all apps of this deployment
+		for keyName in ["blueGreen", "rateLimit"]:
+			if keyName in targetConfig and keyName not in appMeta:
+				appMeta[keyName] = targetConfig[keyName]
+
+	# combine and inject ENV vars from the deploy config
+	env = appMeta.get("env", {}) # start with existing app.json env
+	
+	# Overload env with env from different places in the deployment config
+	# First overload with top level env (used across all deployments)
+	overloadAppEnvFromConfig(env, deployConfig, appName, appMeta["isWebApp"])
+	
+	# Then overload with env specific to this named deployment
+	overloadAppEnvFromConfig(env, targetConfig, appName, appMeta["isWebApp"])
+
+	if "env" in appInfo: # override with specific to this app instance in the server definition
+		env.update(appInfo["env"])
+	
+	# Special env var, for both web and server apps
+	env["APP_WEB_PATH"] = appMeta.get("webPath", "/").rstrip("/")
+	
+	appMeta["env"] = env
+	return appMeta
+
+# Get the server.json of a server as it will be deployed
+# Rate limits of this deployment's domains are included for those domains used by the server, unless the server block
+# sets its own.
+def getDeployedServerBlock(server):
+	serverDomains = getDomainsInServer(server)
+	domainRateLimits = {
+		domain : rateLimit for domain, rateLimit in targetConfig.get("domainRateLimits", {}).items() if domain in serverDomains
+	}
+	
+	domainRateLimits.update(server.get("domainRateLimits", {}))
+	return {**server, "domainRateLimits" : domainRateLimits}
+
+# Build the app as it will be deployed, with its final appMeta.json and any env injected
+# Files are hardlinked from the deployment, and anything modified is replaced rather than written in place. So unchanged
+# files keep their inode and their hashes are already known when building manifests.
+def buildAppArtifact(appMeta, artifactDir):
+	with report.span("stage app", detail = appMeta["appName"]):
+		shutil.copytree(
+			constants.CONTROLSERVER_DEPLOYMENTS_DIR + "/" + deploymentName + "/apps/" + appMeta["appName"],
+			artifactDir,
+			copy_function = linkOrCopyFile
+		)
+		
+		os.remove(artifactDir + "/appMeta.json")
+		
+		with open(artifactDir + "/appMeta.json", "w") as fp:
+			json.dump(appMeta, fp, indent = "\t")
+	
+	# Maybe inject some env into the app's files (e.g. for a client side web app)
+	# injectEnv is a file matching regex, e.g. "\\.(js|html)$"
+	if "injectEnv" in appMeta:
+		with report.span("inject env", detail = appMeta["appName"]):
+			fileInjectEnv(artifactDir, appMeta["injectEnv"], appMeta["env"])
+	
+	# Maybe write compressed copies of a web app's files, to be served by nginx as they are
+	# precompress is either true, for the usual compressible file types, or a file matching regex
+	if appMeta["isWebApp"] and appMeta.get("precompress"):
+		precompressRegex = appMeta["precompress"] if isinstance(appMeta["precompress"], str) else constants.PRECOMPRESS_REGEX
+		
+		with report.span("precompress", detail = appMeta["appName"]):
+			precompressFiles(artifactDir, precompressRegex)
+
+# Each distinct build of an app (same app, same appMeta.json and env) is only built once, and shared by all servers
+# that need it. Keyed by a hash of the app's final appMeta.json.
+# Returns the path of each artifact by key, and the key of the artifact used by each app of each server.
+def buildArtifacts(artifactsDir):
+	artifactPaths = {}
+	artifactKeys = {}
+	
+	for serverIndex, server in enumerate(servers):
+		for appInfo in server["apps"]:
+			appMeta = getDeployedAppMeta(appInfo)
+			artifactKey = hashlib.sha256(json.dumps(appMeta, sort_keys = True).encode()).hexdigest()
+			artifactKeys[(serverIndex, appInfo["app"])] = artifactKey
+
+			if artifactKey not in artifactPaths:
+				artifactPaths[artifactKey] = artifactsDir + "/" + artifactKey
+				buildAppArtifact(appMeta, artifactPaths[artifactKey])
+	
+	appInstanceCount = sum(len(server["apps"]) for server in servers)
+	print(f"Built {len(artifactPaths)} distinct app artifacts for {appInstanceCount} apps across {len(servers)} servers")
+	pruneInjectEnvCache()
+	prunePrecompressCache()
+	return artifactPaths, artifactKeys
+
 # Now want to rsync to each host!
 async def deploy():
 	# Now sync *ONLY* the desired apps and their SSL certs to each host
 	rsyncTasks = []
-	tempDirs = []
+	tempDirs = [artifactsTempDir]
 
-	for server in servers:
+	for serverIndex, server in enumerate(servers):
 		host = hostFromServer(server)
 		
-		tempDir = tempfile.TemporaryDirectory()
+		tempDir = tempfile.TemporaryDirectory(dir = constants.CONTROLSERVER_STAGING_DIR)
 		tempDirs.append(tempDir)
 		
 		# Write out the server block config, to be copied to host
 		# This was added for redirects
 		with open(tempDir.name + "/server.json", "w") as fp:
-			json.dump(server, fp, indent = "\t")
+			json.dump(getDeployedServerBlock(server), fp, indent = "\t")
 
-		# Copy all apps for this server and deployment to a temp dir
-		for appInfo in server["apps"]:
-			appName = appInfo["app"]
-			appTempDir = tempDir.name + "/" + appName
-
-			shutil.copytree(
-				constants.CONTROLSERVER_DEPLOYMENTS_DIR + "/" + deploymentName + "/apps/" + appName,
-				appTempDir
-			)
-
-			# Inject some stuff that's needed by the host server into the app's appMeta.json
-			with open(appTempDir + "/appMeta.json", "r+") as fp:
-				appMeta = json.load(fp)
-				appMeta["appName"] = appName
-				appMeta["deploymentName"] = deploymentName
-
-				# Copy certain keys from appInfo/config only if set
-				for keyName in ["domains", "webPath", "instancesPerCPU", "dataGroup"]:
-					if keyName in appInfo:
-						appMeta[keyName] = appInfo[keyName]
-
-			# combine and inject ENV vars from the deploy config
-			env = appMeta.get("env", {}) # start with existing app.json env
-			
-			# Overload env with env from different places in the deployment config
-			# First overload with top level env (used across all deployments)
-			overloadAppEnvFromConfig(env, deployConfig, appName, appMeta["isWebApp"])
-			
-			# Then overload with env specific to this named deployment
-			overloadAppEnvFromConfig(env, targetConfig, appName, appMeta["isWebApp"])
+		# Add all apps for this server and deployment to a temp dir
+		with report.span("stage server", host):
+			for appInfo in server["apps"]:
+				# Hardlinks, so that a server's copy of an artifact costs no extra copying or disk space
+				artifactPath = artifactPaths[artifactKeys[(serverIndex, appInfo["app"])]]
+				shutil.copytree(artifactPath, tempDir.name + "/" + appInfo["app"], copy_function = linkOrCopyFile)
 
-			if "env" in appInfo: # override with specific to this app instance in the server definition
-				env.update(appInfo["env"])
-			
-			# Special env var, for both web and server apps
-			env["APP_WEB_PATH"] = appMeta.get("webPath", "/").rstrip("/")
-			
-			appMeta["env"] = env
-			
-			with open(appTempDir + "/appMeta.json", "w") as fp:
-				json.dump(appMeta, fp, indent = "\t")
-			
-			# Maybe inject some env into the app's files (e.g. for a client side web app)
-			# injectEnv is a file matching regex, e.g. "\\.(js|html)$"
-			if "injectEnv" in appMeta:
-				fileInjectEnv(appTempDir, appMeta["injectEnv"], env)
-
-		# Rsync the apps to the host
+		# Sync the apps to the host
 		# This will also clear any apps that exist there and are no longer specified in the deployment
-		rsyncTasks.append(rsync(host, getDeploymentKey(deploymentName),
-			tempDir.name + "/",
-			constants.HOSTSERVER_APPS_DIR + "/" + deploymentName + "/"
-		))
-
-		for domainName in getDomainsInServer(server):
-			rsyncTasks.append(rsync(host, getDeploymentKey(deploymentName),
-				getCertPrivkeyPath(domainName),
-				constants.HOSTSERVER_CERTS_DIR + "/"
-			))
-			rsyncTasks.append(rsync(host, getDeploymentKey(deploymentName),
-				getCertFullchainPath(domainName),
-				constants.HOSTSERVER_CERTS_DIR + "/"
-			))
-
-	await asyncio.gather(*rsyncTasks)
+		rsyncTasks.append(syncAppsToHost(host, deploymentName, tempDir.name, hashCache, report))
+
+		# And all certs needed by this host, in one go
+		domains = getDomainsInServer(server)
+		
+		if len(domains) > 0:
+			rsyncTasks.append(report.timeAsync("sync certs", rsyncCerts(host, deploymentName, domains), host))
+
+	# Hosts that fail don't stop the others from syncing
+	results = await asyncio.gather(*rsyncTasks, return_exceptions = True)
 
 	# Clean up tempdirs only after rsyncs have finished
 	for tempDir in tempDirs:
 		tempDir.cleanup()
 
+	hashCache.save()
+
+	for result in results:
+		if isinstance(result, BaseException) and not isinstance(result, HostOperationError):
+			raise result
+
+	if False in results:
+		print("Apps on one or more hosts failed verification after syncing.")
+	
+	if any(result is not True for result in results):
+		sys.exit(constants.REMOTE_EXIT_CODE_HOST_COMMAND_FAILED)
+
 	# Install all apps
-	await runOnAllHosts(hosts, deploymentName, "host_install_apps.py " + localConf.get("letsencryptThumbprint"))
+	if "rollout" in targetConfig:
+		await installInWaves(targetConfig["rollout"])
+	else:
+		await runOnAllHosts(hosts, deploymentName, "host_install_apps.py " + localConf.get("letsencryptThumbprint"), report)
+
+# Rolling deploy, installing on one wave of hosts at a time
+# A wave is only started once every host of the previous wave has installed successfully and its restarted services
+# are ready, so a broken release stops at the first wave rather than taking down every host at once.
+async def installInWaves(rolloutConfig):
+	waves = splitIntoWaves(hosts, rolloutConfig.get("waves", [1, "100%"]))
+	readyTimeout = rolloutConfig.get("readyTimeout", constants.READY_TIMEOUT)
+	commandStr = getHostScriptCommand("host_install_apps.py " + localConf.get("letsencryptThumbprint") + " " + str(readyTimeout))
+	
+	for waveIndex, waveHosts in enumerate(waves):
+		print(f"Installing wave {waveIndex + 1} of {len(waves)}: {waveHosts}")
+		
+		with report.span("install wave", detail = str(waveIndex + 1)):
+			succeeded = await runCommandOnAllHosts(waveHosts, deploymentName, commandStr, report, "host_install_apps.py")
+		
+		if not succeeded:
+			remainingHosts = [host for wave in waves[waveIndex + 1:] for host in wave]
+			print(f"Wave {waveIndex + 1} failed, not installing on the remaining hosts: {remainingHosts}")
+			sys.exit(constants.REMOTE_EXIT_CODE_HOST_COMMAND_FAILED)
+
+# Apps are built before the event loop starts and any host connections are opened, as injecting env and precompressing
+# fork worker processes, which is only safe without other threads running.
+# Temp dirs are kept next to the deployments, so that files can be hardlinked rather than copied into them.
+os.makedirs(constants.CONTROLSERVER_STAGING_DIR, exist_ok = True)
+artifactsTempDir = tempfile.TemporaryDirectory(dir = constants.CONTROLSERVER_STAGING_DIR)
+artifactPaths, artifactKeys = buildArtifacts(artifactsTempDir.name)
 
 asyncio.run(main())
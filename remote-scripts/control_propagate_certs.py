@@ -1,11 +1,10 @@
 import os, asyncio
 from datetime import datetime
-import constants
+from errors import HostOperationError
 from control_utils import (
-	readServers, getCertPrivkeyPath, getCertFullchainPath, getDomainsInServer, runCommandOnAllHosts,
-	getAllDeployments, hostsFromServers, hostFromServer
+	readServers, getDomainsInServer, runCommandOnAllHosts, getAllDeployments, hostsFromServers, hostFromServer,
+	closeHostConnections, rsyncCerts
 )
-from utils import rsync, getDeploymentKey
 
 print("Propagating SSL certs... " + datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
 
@@ -22,19 +21,18 @@ async def propagate():
 		for server in servers:
 			host = hostFromServer(server)
 			
-			for domainName in getDomainsInServer(server):
-				print("Propagating " + domainName + " keys to host " + host)
-				
-				rsyncTasks.append(rsync(host, getDeploymentKey(deploymentName),
-					getCertPrivkeyPath(domainName),
-					constants.HOSTSERVER_CERTS_DIR + "/"
-				))
-				rsyncTasks.append(rsync(host, getDeploymentKey(deploymentName),
-					getCertFullchainPath(domainName),
-					constants.HOSTSERVER_CERTS_DIR + "/"
-				))
+			domains = getDomainsInServer(server)
+			
+			if len(domains) > 0:
+				print("Propagating " + ", ".join(sorted(domains)) + " keys to host " + host)
+				rsyncTasks.append(rsyncCerts(host, deploymentName, domains))
 		
-		await asyncio.gather(*rsyncTasks)
+		# Any hosts that can't be reached don't stop the others from getting their certs
+		for result in await asyncio.gather(*rsyncTasks, return_exceptions = True):
+			if isinstance(result, HostOperationError):
+				print(result)
+			elif isinstance(result, BaseException):
+				raise result
 
 async def reload_nginx():
 	# Reload nginx config on each host so new cert is seen
@@ -46,5 +44,11 @@ async def reload_nginx():
 		if not await runCommandOnAllHosts(hosts, deploymentName, "systemctl --no-block reload nginx"):
 			print("Error, one or more nginx reload commands failed.")
 
-asyncio.run(propagate())
-asyncio.run(reload_nginx())
+async def main():
+	try:
+		await propagate()
+		await reload_nginx()
+	finally:
+		await closeHostConnections()
+
+asyncio.run(main())
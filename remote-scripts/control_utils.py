@@ -1,7 +1,10 @@
-import json, os, sys, asyncio
+import json, os, sys, asyncio, tempfile, math
 import constants
 import asyncssh
-from utils import getProjectNameAndTarget
+from utils import getProjectNameAndTarget, getDeploymentKey, rsync, buildManifest, diffManifests
+from deploy_report import parseHostReports
+from host_scheduler import hostScheduler
+from errors import HostCommandError, HostOperationError
 
 def getCertPrivkeyPath(domain):
 	return constants.CONTROLSERVER_CERTS_DIR + "/" + domain + ".key.pem"
@@ -35,6 +38,25 @@ def getDomainsInServer(server):
 
 	return domainSet
 
+# Rsync the key and fullchain of every given domain to a host, all in a single rsync
+async def rsyncCerts(host, deploymentName, domains):
+	with tempfile.NamedTemporaryFile("w", prefix = constants.TOOL_NAME_LOWERCASE + "-certs-") as fp:
+		for domain in sorted(domains):
+			fp.write(os.path.basename(getCertPrivkeyPath(domain)) + "\n")
+			fp.write(os.path.basename(getCertFullchainPath(domain)) + "\n")
+		
+		fp.flush()
+		
+		# No --delete, the host's certs dir also has certs of other deployments
+		await rsync(host, getDeploymentKey(deploymentName),
+			constants.CONTROLSERVER_CERTS_DIR + "/",
+			constants.HOSTSERVER_CERTS_DIR + "/",
+			["--files-from=" + fp.name],
+			delete = False
+		)
+	
+	return True
+
 def readDeployConfigFromDir(deploymentName, dirPath):
 	with open(dirPath + "/" + deploymentName + "/" + constants.LOCAL_CONFIG_FILE) as fp:
 		return json.load(fp)
@@ -93,6 +115,32 @@ def hostFromServer(server):
 def hostsFromServers(servers):
 	return [hostFromServer(server) for server in servers]
 
+# Split hosts into waves for a rolling deploy
+# Each wave size is a number of hosts, or a percentage of all hosts such as "25%". Any hosts remaining after the given
+# waves are split into further waves the size of the last one. e.g. [1, "10%", "50%"] is a single canary host, then 10%
+# of hosts, then the rest in waves of half of all hosts.
+def splitIntoWaves(hosts, waveSizes):
+	assert len(waveSizes) > 0, "A rollout needs at least one wave"
+	hosts = list(dict.fromkeys(hosts)) # without duplicates, in order
+	waves = []
+	remaining = hosts
+	waveIndex = 0
+	
+	while len(remaining) > 0:
+		waveSize = waveSizes[min(waveIndex, len(waveSizes) - 1)]
+		
+		if isinstance(waveSize, str) and waveSize.endswith("%"):
+			count = math.ceil(len(hosts) * float(waveSize[:-1]) / 100)
+		else:
+			count = int(waveSize)
+		
+		count = max(count, 1)
+		waves.append(remaining[:count])
+		remaining = remaining[count:]
+		waveIndex += 1
+	
+	return waves
+
 # Write correct host fingerprints to known_hosts
 # This must be done for *all* deployments on this control server, not just the one that is currently being deployed.
 def writeKnownHosts():
@@ -106,33 +154,100 @@ def writeKnownHosts():
 			if "ipv6" in server:
 				fp.write(server["ipv6"] + " ssh-ed25519 " + server["fingerprint"] + "\n")
 
-async def _runCommandOnHostNoRetry(host, deploymentName, commandStr):
-	keyPath = constants.CONTROLSERVER_DEPLOYMENTS_DIR + "/" + deploymentName + "/control-key"
+# Pool of ssh connections to hosts, keyed by (host, deploymentName), reused by every command run during this process.
+# Values are tasks rather than connections, so that concurrent callers wait on the same connection attempt.
+hostConnections = {}
+
+async def getHostConnection(host, deploymentName):
+	key = (host, deploymentName)
 	
-	async with asyncssh.connect(host, client_keys = [keyPath]) as conn:
-		result = await conn.run(commandStr)
-		
-		if result.returncode != 0:
-			print("Server command failed.")
-			print("Command exit code: " + str(result.returncode))
-			print("Command stdout: " + "".join(result.stdout))
-			print("Command stderr: " + "".join(result.stderr))
-			return False
+	if key not in hostConnections:
+		hostConnections[key] = asyncio.ensure_future(asyncssh.connect(host,
+			client_keys = [getDeploymentKey(deploymentName)],
+			keepalive_interval = constants.SSH_KEEPALIVE_INTERVAL
+		))
+	
+	connectTask = hostConnections[key]
+	
+	try:
+		return await connectTask
+	except:
+		# Failed to connect, so the next attempt will reconnect
+		if hostConnections.get(key) is connectTask:
+			del hostConnections[key]
 		
-		return True
+		raise
+
+# Drop a broken connection from the pool, so that the next attempt reconnects
+def discardHostConnection(host, deploymentName, conn):
+	key = (host, deploymentName)
+	connectTask = hostConnections.get(key)
+	
+	if connectTask and connectTask.done() and not connectTask.cancelled() and connectTask.exception() is None:
+		if connectTask.result() is conn:
+			del hostConnections[key]
+	
+	conn.close()
 
-async def runCommandOnHost(host, deploymentName, commandStr):
-	while True:
+async def closeHostConnections():
+	connectTasks = list(hostConnections.values())
+	hostConnections.clear()
+	
+	for connectTask in connectTasks:
 		try:
-			return await _runCommandOnHostNoRetry(host, deploymentName, commandStr)
-		except Exception as error:
-			print(error)
-			print(commandStr)
-			print(f"Master server failed to run command on {host}, will retry...");
-			await asyncio.sleep(5)
-
-async def runCommandOnAllHosts(hosts, deploymentName, commandStr):
-	results = await asyncio.gather(*[runCommandOnHost(host, deploymentName, commandStr) for host in hosts])
+			conn = await connectTask
+		except Exception:
+			continue
+		
+		conn.close()
+		await conn.wait_closed()
+
+# Any reports printed by the command are merged into report, if given
+async def _runCommandOnHostNoRetry(host, deploymentName, commandStr, report = None):
+	conn = await getHostConnection(host, deploymentName)
+	
+	try:
+		result = await conn.run(commandStr)
+	except:
+		discardHostConnection(host, deploymentName, conn)
+		raise
+	
+	# Also from failed commands, which may report how far they got
+	if report:
+		for hostReport in parseHostReports(result.stdout):
+			report.addHostReport(host, hostReport)
+	
+	if result.returncode != 0:
+		print("Server command failed.")
+		print("Command exit code: " + str(result.returncode))
+		print("Command stdout: " + "".join(result.stdout))
+		print("Command stderr: " + "".join(result.stderr))
+		raise HostCommandError(host, result.returncode)
+	
+	return True
+
+# Returns whether the command succeeded
+# Connection errors are retried by the host scheduler, but not a command that ran and failed.
+async def runCommandOnHost(host, deploymentName, commandStr, report = None, name = None):
+	try:
+		return await hostScheduler.run(host, name or commandStr,
+			lambda: _runCommandOnHostNoRetry(host, deploymentName, commandStr, report),
+			retryOn = (OSError, asyncssh.Error)
+		)
+	except (HostCommandError, HostOperationError) as error:
+		print(error)
+		return False
+
+# If a report is given, the command is timed on each host as spanName
+# All hosts are started at once, the host scheduler limits how many actually run at the same time.
+async def runCommandOnAllHosts(hosts, deploymentName, commandStr, report = None, spanName = None):
+	if report:
+		results = await asyncio.gather(*[
+			report.timeAsync(spanName, runCommandOnHost(host, deploymentName, commandStr, report, spanName), host) for host in hosts
+		])
+	else:
+		results = await asyncio.gather(*[runCommandOnHost(host, deploymentName, commandStr, name = spanName) for host in hosts])
+	
 	allSucceeded = all(results)
 	
 	if not allSucceeded:
@@ -141,8 +256,77 @@ async def runCommandOnAllHosts(hosts, deploymentName, commandStr):
 	# Return true if ALL commands succeeded, false if any failed
 	return allSucceeded
 
+# Command to run one of the scripts on a host, with any arguments
+def getHostScriptCommand(scriptName):
+	return f"python3 -B -u {constants.HOSTSERVER_SCRIPTS_DIR}/{scriptName}"
+
 # Run a script across *all* hosts
 # Also exits if anything fails, this is currently assumed to only be used by deploy script
-async def runOnAllHosts(hosts, deploymentName, scriptName):
-	if not await runCommandOnAllHosts(hosts, deploymentName, f"python3 -B -u {constants.HOSTSERVER_SCRIPTS_DIR}/{scriptName}"):
+async def runOnAllHosts(hosts, deploymentName, scriptName, report = None):
+	if not await runCommandOnAllHosts(hosts, deploymentName, getHostScriptCommand(scriptName), report, scriptName.split(" ")[0]):
 		sys.exit(constants.REMOTE_EXIT_CODE_HOST_COMMAND_FAILED)
+
+def getHostManifestPath(deploymentName, host):
+	return constants.CONTROLSERVER_MANIFESTS_DIR + "/" + deploymentName + "/host-" + host + ".json"
+
+async def verifyAppsOnHost(host, deploymentName, report):
+	return await report.timeAsync("verify apps", runCommandOnHost(host, deploymentName,
+		getHostScriptCommand("host_verify_apps.py " + deploymentName),
+		name = "host_verify_apps.py"
+	), host)
+
+# Sync a deployment's staged apps to a host
+# The manifest of what was last synced to each host is kept, so normally only changed files are sent, and missing ones
+# deleted, without rsync having to read every file on both sides. The host then verifies everything against the full
+# manifest. If there's no previous manifest, or verification fails, falls back to a full rsync --checksum.
+# Each step is timed for this host in report.
+async def syncAppsToHost(host, deploymentName, stagingDir, hashCache, report):
+	with report.span("build manifest", host):
+		manifest = buildManifest(stagingDir, hashCache, exclude = [constants.MANIFEST_FILE])
+	
+	with open(stagingDir + "/" + constants.MANIFEST_FILE, "w") as fp:
+		json.dump(manifest, fp)
+	
+	keyPath = getDeploymentKey(deploymentName)
+	dest = constants.HOSTSERVER_APPS_DIR + "/" + deploymentName + "/"
+	hostManifestPath = getHostManifestPath(deploymentName, host)
+	verified = False
+	
+	try:
+		with open(hostManifestPath) as fp:
+			hostManifest = json.load(fp)
+	except FileNotFoundError:
+		hostManifest = None
+	
+	if hostManifest is not None:
+		changed, deleted = diffManifests(hostManifest, manifest)
+		print(f"Sending {len(changed)} changed and deleting {len(deleted)} files of {deploymentName} on {host}")
+		
+		with tempfile.NamedTemporaryFile("w", prefix = constants.TOOL_NAME_LOWERCASE + "-files-") as fp:
+			fp.write("".join([relPath + "\n" for relPath in changed + [constants.MANIFEST_FILE] + deleted]))
+			fp.flush()
+			
+			# Deleted paths don't exist in the staging dir, so become deletions on the host
+			await report.timeAsync("rsync changed apps", rsync(host, keyPath, stagingDir + "/", dest,
+				["--files-from=" + fp.name, "--delete-missing-args", "--force"],
+				delete = False, checksum = False
+			), host)
+		
+		verified = await verifyAppsOnHost(host, deploymentName, report)
+	
+	if not verified:
+		print(f"Sending all files of {deploymentName} to {host}")
+		
+		# This will also clear any apps that exist there and are no longer specified in the deployment
+		await report.timeAsync("rsync all apps", rsync(host, keyPath, stagingDir + "/", dest), host)
+		verified = await verifyAppsOnHost(host, deploymentName, report)
+	
+	if verified:
+		os.makedirs(os.path.dirname(hostManifestPath), exist_ok = True)
+		
+		with open(hostManifestPath, "w") as fp:
+			json.dump(manifest, fp)
+	elif os.path.isfile(hostManifestPath):
+		os.remove(hostManifestPath)
+	
+	return verified
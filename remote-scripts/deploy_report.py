@@ -0,0 +1,139 @@
+import os, json, time, contextlib
+import constants
+
+# Report of what happened during a deploy, saved as JSON on the control server
+# Records how long each phase took, with a breakdown per host. Scripts run on hosts build their own report of their
+# internal phases and print it for the control server, which merges it in under that host.
+class DeployReport:
+	def __init__(self):
+		self.startTime = time.time()
+		self.spans = []
+		self.hostReports = {}
+		self.currentPhase = None
+
+	def addSpan(self, name, startTime, duration, host = None, detail = None, remote = False):
+		span = {
+			"name" : name,
+			"start" : round(startTime - self.startTime, 3),
+			"duration" : round(duration, 3)
+		}
+
+		if host:
+			span["host"] = host
+		if detail:
+			span["detail"] = detail
+		if remote:
+			span["remote"] = True
+
+		self.spans.append(span)
+
+	@contextlib.contextmanager
+	def span(self, name, host = None, detail = None):
+		startTime = time.time()
+
+		try:
+			yield
+		finally:
+			self.addSpan(name, startTime, time.time() - startTime, host, detail)
+
+	async def timeAsync(self, name, awaitable, host = None, detail = None):
+		with self.span(name, host, detail):
+			return await awaitable
+
+	# For top level script code, where wrapping every phase in a with block would be awkward
+	# A phase lasts until the next one starts, or until endPhase is called.
+	def phase(self, name):
+		self.endPhase()
+		self.currentPhase = (name, time.time())
+
+	def endPhase(self):
+		if self.currentPhase:
+			name, startTime = self.currentPhase
+			self.addSpan(name, startTime, time.time() - startTime)
+			self.currentPhase = None
+
+	# Print this report on a line of its own, to be picked up by the control server from the script's output
+	# Extra keys (anything but timing) are kept as they are in that host's breakdown.
+	def printForControl(self, extra = {}):
+		self.endPhase()
+
+		print(constants.REMOTE_REPORT_PREFIX + json.dumps({
+			"timing" : {"startTime" : self.startTime, "spans" : self.spans},
+			**extra
+		}))
+
+	# Merge in a report printed by printForControl on a host
+	# Its spans are placed using the host's clock, so may be slightly off relative to the control server's spans.
+	def addHostReport(self, host, hostReport):
+		timing = hostReport.get("timing")
+
+		if timing:
+			for span in timing["spans"]:
+				self.addSpan(span["name"], timing["startTime"] + span["start"], span["duration"], host, span.get("detail"), True)
+
+		for key, value in hostReport.items():
+			if key != "timing":
+				self.hostReports.setdefault(host, {})[key] = value
+
+	def toDict(self):
+		self.endPhase()
+		hosts = {}
+
+		for span in self.spans:
+			if "host" in span:
+				hostBreakdown = hosts.setdefault(span["host"], {"total" : 0, "phases" : {}, "remotePhases" : {}, "spans" : []})
+				phases = hostBreakdown["remotePhases"] if span.get("remote") else hostBreakdown["phases"]
+				phases[span["name"]] = round(phases.get(span["name"], 0) + span["duration"], 3)
+				hostBreakdown["spans"].append(span)
+
+				# Remote phases happen during the control server's spans for that host, so aren't counted twice
+				if not span.get("remote"):
+					hostBreakdown["total"] = round(hostBreakdown["total"] + span["duration"], 3)
+
+		for host, hostReport in self.hostReports.items():
+			hosts.setdefault(host, {"total" : 0, "phases" : {}, "remotePhases" : {}, "spans" : []}).update(hostReport)
+
+		return {
+			"startTime" : self.startTime,
+			"duration" : round(time.time() - self.startTime, 3),
+			"phases" : [span for span in self.spans if "host" not in span],
+			"hosts" : hosts
+		}
+
+	# Save to a new timestamped file in dirPath, keeping only the most recent reports
+	def save(self, dirPath):
+		report = self.toDict()
+		os.makedirs(dirPath, exist_ok = True)
+
+		with open(dirPath + "/" + time.strftime("%Y%m%d-%H%M%S", time.gmtime(self.startTime)) + ".json", "w") as fp:
+			json.dump(report, fp, indent = "\t")
+
+		fileNames = sorted([fileName for fileName in os.listdir(dirPath) if fileName.endswith(".json")])
+
+		for fileName in fileNames[:-constants.DEPLOY_REPORTS_KEPT]:
+			os.remove(dirPath + "/" + fileName)
+
+		return report
+
+	def printSummary(self):
+		report = self.toDict()
+		print(f"Deploy took {report['duration']:.2f}s")
+
+		# Phases that happen many times (e.g. per app) are summed
+		phaseTotals = {}
+
+		for span in report["phases"]:
+			phaseTotals[span["name"]] = phaseTotals.get(span["name"], 0) + span["duration"]
+
+		for name, duration in phaseTotals.items():
+			print(f"  {name}: {duration:.2f}s")
+
+		print("Slowest hosts:")
+		slowestHosts = sorted(report["hosts"].items(), key = lambda item: item[1]["total"], reverse = True)[:5]
+
+		for host, hostBreakdown in slowestHosts:
+			print(f"  {host}: {hostBreakdown['total']:.2f}s")
+
+# Reports printed by printForControl in the output of a command run on a host
+def parseHostReports(output):
+	return [json.loads(line[len(constants.REMOTE_REPORT_PREFIX):]) for line in output.splitlines() if line.startswith(constants.REMOTE_REPORT_PREFIX)]
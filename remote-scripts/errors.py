@@ -3,3 +3,23 @@ class HostVerificationError(Exception):
     def __init__(self, host):
         self.host = host
         super().__init__(f"Host verification failed for host {host}")
+
+class TemplateError(Exception):
+    def __init__(self, templateName, missing, unknown):
+        super().__init__(f"Template {templateName} rendered with missing placeholders {missing} and unknown placeholders {unknown}")
+
+class NginxConfigError(Exception):
+    def __init__(self, output):
+        super().__init__(f"New nginx config failed nginx -t, it was not installed:\n{output}")
+
+class HostCommandError(Exception):
+    def __init__(self, host, returncode):
+        self.host = host
+        self.returncode = returncode
+        super().__init__(f"Command on host {host} failed with exit code {returncode}")
+
+class HostOperationError(Exception):
+    def __init__(self, host, name, reason):
+        self.host = host
+        self.name = name
+        super().__init__(f"{name} on host {host} {reason}")
@@ -0,0 +1,101 @@
+import os, stat, shutil, hashlib, secrets, threading
+from utils import FileHashCache, fastCopyFile
+
+# Content addressed store for installed app files, on the host server
+# Each distinct file (contents + permission bits) is stored once, and installed apps are built from hardlinks into
+# the store. Unchanged files cost a link rather than a copy, and files shared across apps and deployments are only
+# stored once. Trees may be installed from several threads at once.
+class FileStore:
+	def __init__(self, storeDir, hashCachePath):
+		self.storeDir = storeDir
+		self.hashCache = FileHashCache(hashCachePath)
+		self.linkedCount = 0
+		self.addedCount = 0
+		self.countLock = threading.Lock()
+		os.makedirs(storeDir, exist_ok = True)
+
+	def _getStorePath(self, digest, mode):
+		key = digest + "-" + format(mode, "o")
+		return self.storeDir + "/" + key[:2] + "/" + key
+
+	def _addToStore(self, sourcePath, storePath, mode):
+		os.makedirs(os.path.dirname(storePath), exist_ok = True)
+		tempPath = storePath + "." + secrets.token_hex(8) + ".tmp"
+
+		try:
+			fastCopyFile(sourcePath, tempPath)
+			os.chmod(tempPath, mode)
+
+			# link rather than rename, so a file added meanwhile under the same key is never replaced
+			try:
+				os.link(tempPath, storePath)
+				
+				with self.countLock:
+					self.addedCount += 1
+			except FileExistsError:
+				pass
+		finally:
+			os.remove(tempPath)
+
+	def _installFile(self, sourcePath, destPath, sourceStat):
+		mode = stat.S_IMODE(sourceStat.st_mode)
+		digest = self.hashCache.hash(sourcePath, sourceStat)
+		storePath = self._getStorePath(digest, mode)
+
+		if not os.path.exists(storePath):
+			self._addToStore(sourcePath, storePath, mode)
+
+		try:
+			os.link(storePath, destPath)
+			
+			with self.countLock:
+				self.linkedCount += 1
+		except OSError:
+			# e.g. different filesystem or too many links, just copy it
+			fastCopyFile(storePath, destPath)
+			shutil.copystat(storePath, destPath)
+
+		return digest, mode
+
+	def _installDir(self, sourceDir, destDir, relDir, treeHash):
+		os.mkdir(destDir)
+		shutil.copymode(sourceDir, destDir)
+
+		for dirent in sorted(os.scandir(sourceDir), key = lambda dirent: dirent.name):
+			relPath = relDir + "/" + dirent.name
+			destPath = destDir + "/" + dirent.name
+
+			if dirent.is_symlink():
+				linkTarget = os.readlink(dirent.path)
+				os.symlink(linkTarget, destPath)
+				treeHash.update(f"link {relPath} {linkTarget}\n".encode())
+			elif dirent.is_dir():
+				treeHash.update(f"dir {relPath}\n".encode())
+				self._installDir(dirent.path, destPath, relPath, treeHash)
+			elif dirent.is_file():
+				digest, mode = self._installFile(dirent.path, destPath, dirent.stat())
+				treeHash.update(f"file {relPath} {mode:o} {digest}\n".encode())
+
+	# Install sourceDir to destDir (which must not exist yet)
+	# Returns a hash of the entire tree, which only changes if some file, link or permission changed
+	def installTree(self, sourceDir, destDir):
+		treeHash = hashlib.sha256()
+		os.makedirs(os.path.dirname(destDir), exist_ok = True)
+		self._installDir(sourceDir, destDir, "", treeHash)
+		return treeHash.hexdigest()
+
+	def saveHashCache(self):
+		self.hashCache.save()
+
+	# Delete stored files that are no longer linked from any installed app
+	# Must only be called once old install dirs have been removed
+	def purgeUnused(self):
+		purgedCount = 0
+
+		for dirent in os.scandir(self.storeDir):
+			for fileDirent in os.scandir(dirent.path):
+				if fileDirent.name.endswith(".tmp") or fileDirent.stat().st_nlink <= 1:
+					os.remove(fileDirent.path)
+					purgedCount += 1
+
+		return purgedCount
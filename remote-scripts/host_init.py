@@ -3,9 +3,14 @@ import constants
 from pathlib import Path
 from utils import runCommand
 from host_utils import fromTemplate
+from deploy_report import DeployReport
 
 print("Will init this server!")
 
+# Timing of each phase, sent back to the control server
+report = DeployReport()
+report.phase("init common")
+
 import both_init
 
 deploymentName = sys.argv[1]
@@ -19,9 +24,12 @@ print("Letsencrypt thumbprint:", letsencryptThumbprint)
 os.makedirs(constants.HOSTSERVER_APPS_DIR, exist_ok = True)
 os.makedirs(constants.HOSTSERVER_APPS_DIR + "/" + deploymentName, exist_ok = True)
 os.makedirs(constants.HOSTSERVER_INSTALLED_APPS_DIR, exist_ok = True)
+os.makedirs(constants.HOSTSERVER_FILE_STORE_DIR, exist_ok = True)
 os.makedirs(constants.HOSTSERVER_CERTS_DIR, exist_ok = True)
 
 # Install nginx
+report.phase("install nginx")
+
 if shutil.which("nginx") == None:
 	runCommand(["apt", "update"])
 	runCommand(["apt", "install", "-y", "nginx"])
@@ -30,6 +38,7 @@ if shutil.which("nginx") == None:
 # Check for existence of appcontrol's customised nginx conf (via a magic string). If it doesn't exist yet, create a
 # basic bootstrap one to handle the HTTP letsencrypt challenge
 
+report.phase("nginx bootstrap config")
 nginxConf = Path(constants.NGINX_CONF_PATH).read_text()
 
 if constants.NGINX_CONF_MAGIC not in nginxConf:
@@ -42,3 +51,5 @@ if constants.NGINX_CONF_MAGIC not in nginxConf:
 	
 	# Reload nginx
 	runCommand(["systemctl", "--no-block", "reload", "nginx"])
+
+report.printForControl()
@@ -1,28 +1,43 @@
 # Install all apps that have been deployed to this server
-import os, json, secrets, shutil, importlib, glob, sys, pwd
+import os, json, secrets, shutil, importlib, glob, sys, pwd, hashlib, time
 import constants
 from pathlib import Path
 from utils import runCommand, ConfigStore
 from host_utils import (
-	fromTemplate, loadRuntimes, getAppInstalledPath, getInstanceCount, getServiceName, formatEnvForSystemd,
-	genUserName, genDataGroupUserName, getAppLogDir, getAppDataDir, getAppTempDir
+	fromTemplate, loadRuntimes, getAppInstallDir, getAppInstalledPath, getInstanceCount, getServiceName, formatEnvForSystemd,
+	genUserName, genDataGroupUserName, getAppLogDir, getAppDataDir, getAppTempDir, systemctlBatch, getOtherServiceSlot,
+	getAvailableCPUCount, getCPUPinning, getResourceControls, getHostMemory, parseMemorySize, getSocketName,
+	getUnixSocketPath, runInPool
 )
-from build_nginx_config import buildNginxConf
+from build_nginx_config import buildNginxConf, prepareNginxConf, installNginxConf, purgeProxyCacheDirs
+from file_store import FileStore
+from deploy_report import DeployReport
+from host_probes import probeInstances, printProbeResults
 
 print("Will install apps on this server!")
 
+# Timing of each phase, sent back to the control server
+report = DeployReport()
+
 letsencryptThumbprint = sys.argv[1]
 assert(len(letsencryptThumbprint) > 0)
 
+# If given, wait this many seconds for restarted services to be ready, and fail if they aren't (for rolling deploys)
+# Otherwise services are still probed for the default time, but only reported if they aren't ready.
+readyTimeout = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+
 # Import runtime plugins
 runtimes = loadRuntimes()
 
 # A place to store some local state for host server
 localConf = ConfigStore(constants.HOSTSERVER_CONF_PATH)
 
+report.phase("read apps")
+
 # All apps and redirects found across all deployments
 allApps = []
 allRedirects = []
+allDomainRateLimits = {}
 
 # All used runtimes
 usedRuntimes = set()
@@ -35,6 +50,11 @@ for deploymentName in os.listdir(constants.HOSTSERVER_APPS_DIR):
 		if "redirects" in serverBlock:
 			for redirect in serverBlock["redirects"]:
 				allRedirects.append(redirect)
+		
+		allDomainRateLimits.update(serverBlock.get("domainRateLimits", {}))
+		
+		# Unix domain sockets may be used by all server apps of the deployment on this server, or only by some
+		unixSockets = serverBlock.get("unixSockets", False)
 	
 	# Find all apps
 	for dirent in os.scandir(constants.HOSTSERVER_APPS_DIR + "/" + deploymentName):
@@ -58,6 +78,22 @@ for deploymentName in os.listdir(constants.HOSTSERVER_APPS_DIR):
 				"domains" : appMeta.get("domains", None),
 				"webPath" : appMeta.get("webPath", "/"),
 				"instancesPerCPU" : appMeta.get("instancesPerCPU", 0),
+				"instances" : appMeta.get("instances", None),
+				"maxInstances" : appMeta.get("maxInstances", None),
+				"cpuAffinity" : appMeta.get("cpuAffinity", None),
+				"resources" : appMeta.get("resources", {}),
+				"blueGreen" : appMeta.get("blueGreen", False),
+				"socketActivation" : appMeta.get("socketActivation", False),
+				"unixSocket" : appMeta.get("unixSocket", unixSockets) and not appMeta.get("socketActivation", False),
+				"healthCheck" : appMeta.get("healthCheck", {}),
+				# Apps without domains are daemons that may not listen at all, so are only probed if they have a healthCheck
+				"probed" : appMeta.get("healthCheck", {}) is not False and (bool(appMeta.get("domains")) or "healthCheck" in appMeta),
+				"upstream" : appMeta.get("upstream", {}),
+				"proxyCache" : appMeta.get("proxyCache", False),
+				"rateLimit" : appMeta.get("rateLimit", None),
+				"precompress" : appMeta.get("precompress", False),
+				"immutableAssets" : appMeta.get("immutableAssets", False),
+				"openFileCache" : appMeta.get("openFileCache", False),
 				"isWebApp" : appMeta["isWebApp"],
 				"runtime" : appMeta.get("runtime", None),
 				"main" : appMeta.get("main", None),
@@ -77,6 +113,11 @@ for appInfo in allApps:
 			assert hash not in domainAndWebPathSet, ("Same domain and webPath in more than one app: " + appInfo["appName"])
 			domainAndWebPathSet.add(hash)
 
+# A socket activated app's socket accepts connections even before the app is ready, so only a request can tell
+for appInfo in allApps:
+	if appInfo["socketActivation"] and not appInfo["isWebApp"] and appInfo["probed"]:
+		assert "path" in appInfo["healthCheck"], ("socketActivation requires a healthCheck path, for app " + appInfo["appName"])
+
 # We increment the start port by 1000 each time, just in case some old processes were
 # hanging on to ports for a while when shutting down.
 
@@ -88,37 +129,66 @@ if portIndex >= constants.SERVERAPP_PORT_START + 5000:
 
 localConf.set("lastPortStart", portIndex)
 
-# Go through all apps again and determine port ranges and real instance counts
+# Likewise, unix domain sockets of restarted instances get a new path each time
+unixSocketGeneration = localConf.get("lastUnixSocketGeneration", 0) + 1
+localConf.set("lastUnixSocketGeneration", unixSocketGeneration)
+
+# Go through all apps again and determine real instance counts
 # Also create users etc
+report.phase("create users and dirs")
 
-for appInfo in allApps:
-	if not appInfo["isWebApp"]:
-		# Ports
-		instanceCount = getInstanceCount(appInfo["instancesPerCPU"])
-		appInfo["instanceCount"] = instanceCount
-		appInfo["portRangeStart"] = portIndex
-		portIndex += instanceCount
-		
-		# Create users for server apps only
-		# add user if doesn't exist already
-		try:
-			pwd.getpwnam(appInfo["username"])
-		except KeyError:
-			runCommand(["useradd", appInfo["username"]])
-		
-		# Create log directory
-		os.makedirs(appInfo["logDir"], exist_ok = True)
-		shutil.chown(appInfo["logDir"], appInfo["username"], appInfo["username"])
-		
-		# Create logrotate config for this app
-		Path("/etc/logrotate.d/" + constants.TOOL_NAME_LOWERCASE + "." + appInfo["deploymentName"] + "." + appInfo["appName"]).write_text(fromTemplate("logrotate.template", {
-			"###LOG_DIR###" : appInfo["logDir"],
-			"###USER###" : appInfo["username"]
-		}))
+serverApps = [appInfo for appInfo in allApps if not appInfo["isWebApp"]]
+
+for appInfo in serverApps:
+	# Instances. Ports are allocated later, once we know which services are unchanged.
+	appInfo["instanceCount"] = getInstanceCount(appInfo)
+	appInfo["resourceControls"] = getResourceControls(appInfo)
+	
+	# Create users for server apps only
+	# add user if doesn't exist already. One at a time, as useradd locks /etc/passwd.
+	try:
+		pwd.getpwnam(appInfo["username"])
+	except KeyError:
+		runCommand(["useradd", appInfo["username"]])
+
+# Then each app's dirs, all apps at once
+def createAppDirs(appInfo):
+	# Create log directory
+	os.makedirs(appInfo["logDir"], exist_ok = True)
+	shutil.chown(appInfo["logDir"], appInfo["username"], appInfo["username"])
+	
+	# Create logrotate config for this app
+	Path("/etc/logrotate.d/" + constants.TOOL_NAME_LOWERCASE + "." + appInfo["deploymentName"] + "." + appInfo["appName"]).write_text(fromTemplate("logrotate.template", {
+		"###LOG_DIR###" : appInfo["logDir"],
+		"###USER###" : appInfo["username"]
+	}))
+
+	# Create data dir, with correct permissions
+	os.makedirs(appInfo["dataDir"], mode=0o755, exist_ok = True)
+	shutil.chown(appInfo["dataDir"], appInfo["username"], appInfo["username"])
+
+runInPool(createAppDirs, serverApps)
+
+# Apps sized per CPU each assume they have every CPU, so several of them on one host compete for the same CPUs
+availableCPUCount = getAvailableCPUCount()
+perCPUInstanceCount = sum([
+	appInfo["instanceCount"] for appInfo in allApps
+	if not appInfo["isWebApp"] and not appInfo["instances"] and appInfo["instancesPerCPU"] > 0
+])
+print(f"{perCPUInstanceCount} server app instances sized per CPU, on {availableCPUCount} available CPUs")
 
-		# Create data dir, with correct permissions
-		os.makedirs(appInfo["dataDir"], mode=0o755, exist_ok = True)
-		shutil.chown(appInfo["dataDir"], appInfo["username"], appInfo["username"])
+if perCPUInstanceCount > availableCPUCount:
+	print("Warning: CPUs are oversubscribed, consider setting instances or maxInstances of some apps")
+
+# Likewise memory, though instances rarely all use up to their memoryMax at once
+hostMemory = getHostMemory()
+maxMemory = sum([
+	(parseMemorySize(appInfo["resources"]["memoryMax"], hostMemory) or 0) * appInfo["instanceCount"] for appInfo in allApps
+	if not appInfo["isWebApp"] and "memoryMax" in appInfo["resources"]
+])
+
+if maxMemory > hostMemory:
+	print("Warning: memoryMax of all server app instances adds up to more than this host's memory")
 
 
 # return (name, version) from a string like "node:16". version may be None.
@@ -134,10 +204,15 @@ def splitRuntimeVersion(runtimeName):
 
 # Install runtimes (e.g. nodejs)
 # Ensure all runtimes (and correct versions) are installed on this host
+# Also record the actual installed version, since e.g. "node" may have just been upgraded to a newer latest
+runtimeInstalledVersions = {}
+report.phase("install runtimes")
+
 for runtimeName in usedRuntimes:
 	name, version = splitRuntimeVersion(runtimeName)	
 	# Install runtime, passing the version
 	runtimes[name].install(version)
+	runtimeInstalledVersions[runtimeName] = runtimes[name].getInstalledVersion(version)
 
 # Group apps AND redirects by domain name
 # If an app doesn't have a domain, omit it. Won't be routed to by nginx, e.g. a server daemon.
@@ -162,85 +237,454 @@ for redirectInfo in allRedirects:
 			
 		thingsByDomain[domain]["redirects"].append(redirectInfo)
 
-# First, find old install dir(s)
-# Should only be a single dir, but we'll treat it as many just in case there were ever some errors
-# that led to multiple dirs.
-oldInstallDirs = os.listdir(constants.HOSTSERVER_INSTALLED_APPS_DIR)
-
-# create a NEW installed www/app dir, with some random ID in it
-# e.g. /var/lib/appcontrol/asufhajghahg
-newInstallDir = constants.HOSTSERVER_INSTALLED_APPS_DIR + "/" + secrets.token_hex(16)
-os.makedirs(newInstallDir, exist_ok = True)
-
-# copy all apps (web and server) to subdirs in it. just the release dir.
-# ( /deploymentName/appName )
-for appInfo in allApps:
-	shutil.copytree(
+# Along with any rate limit of the domain, from the server.json of its deployment
+for domain, rateLimit in allDomainRateLimits.items():
+	if domain in thingsByDomain:
+		thingsByDomain[domain]["rateLimit"] = rateLimit
+
+# Install all apps (web and server), just the release dir, to a dir named after the hash of their release tree.
+# ( /deploymentName/appName/releaseHash )
+# An unchanged app therefore keeps the same path, and its services can be left running.
+# Files are hardlinked from the content addressed file store, so only new or changed files are actually copied.
+# Apps are installed at once, as each has its own install dir.
+report.phase("install apps")
+fileStore = FileStore(constants.HOSTSERVER_FILE_STORE_DIR, constants.HOSTSERVER_FILE_HASH_CACHE_PATH)
+
+def installApp(appInfo):
+	incomingPath = getAppInstallDir(appInfo) + "/incoming-" + secrets.token_hex(8)
+	
+	appInfo["releaseHash"] = fileStore.installTree(
 		constants.HOSTSERVER_APPS_DIR + "/" + appInfo["deploymentName"] + "/" + appInfo["appName"] + "/release",
-		getAppInstalledPath(newInstallDir, appInfo)
+		incomingPath
 	)
+	
+	if os.path.isdir(getAppInstalledPath(appInfo)): # Already installed and unchanged
+		shutil.rmtree(incomingPath)
+	else:
+		os.rename(incomingPath, getAppInstalledPath(appInfo))
+
+runInPool(installApp, allApps)
+fileStore.saveHashCache()
+print(f"Installed apps, {fileStore.addedCount} new files added to the file store, {fileStore.linkedCount} files linked")
+
+def buildServiceUnit(appInfo, instanceNum, port):
+	runtimeName, runtimeVersion = splitRuntimeVersion(appInfo["runtime"])
+	runtime = runtimes[runtimeName]
+	
+	workingDirectory = getAppInstalledPath(appInfo)
+	mainScriptPath = workingDirectory + "/" + appInfo["main"]
+	
+	# A socket activated instance is started with its socket, which is passed to it as file descriptor 3
+	if appInfo["socketActivation"]:
+		socketName = getSocketName(getServiceName(appInfo["deploymentName"], appInfo["appName"], instanceNum))
+		unitDependencies = "Requires=" + socketName + "\nAfter=" + socketName
+	else:
+		unitDependencies = ""
+	
+	# An instance listening on a unix domain socket is given its path as PORT (which e.g. Node's server.listen() accepts
+	# as it is) and as SOCKET_PATH. Any socket left from a previous run is removed first, and its own once stopped. The
+	# sockets dir belongs to nginx's group, which sockets created in it inherit, and the umask lets that group connect
+	# to them.
+	if appInfo["unixSocket"]:
+		socketDir = os.path.dirname(port)
+		unixSocket = "\n".join([
+			"Environment=SOCKET_PATH=" + port,
+			"ExecStartPre=+mkdir -p " + socketDir,
+			"ExecStartPre=+chown " + appInfo["username"] + ":" + constants.NGINX_USER + " " + socketDir,
+			"ExecStartPre=+chmod 2770 " + socketDir,
+			"ExecStartPre=+rm -f " + port,
+			"ExecStopPost=+rm -f " + port,
+			"UMask=0002"
+		])
+	else:
+		unixSocket = ""
+	
+	return fromTemplate("systemd-service.template", {
+		"###UNIT_DEPENDENCIES###" : unitDependencies,
+		"###USER###" : appInfo["username"],
+		"###PORT###" : str(port),
+		"###APP_DATA_DIR###" : appInfo["dataDir"],
+		"###APP_LOG_DIR###" : appInfo["logDir"],
+		"###APP_TEMP_DIR###" : getAppTempDir(appInfo["deploymentName"], appInfo["username"]),
+		"###ENVIRONMENT###" : formatEnvForSystemd({
+			# Use env vars from the runtime and also the app.json
+			# app.json having precedence
+			**runtime.getEnv(runtimeVersion),
+			**appInfo["env"]
+		}),
+		"###UNIX_SOCKET###" : unixSocket,
+		"###WORKING_DIRECTORY###" : workingDirectory,
+		"###EXEC_CMD###" : runtime.getRunCommand(mainScriptPath, runtimeVersion),
+		"###CPU_PINNING###" : getCPUPinning(appInfo, instanceNum),
+		"###RESOURCE_CONTROLS###" : appInfo["resourceControls"]
+	})
+
+def buildSocketUnit(serviceName, port):
+	return fromTemplate("systemd-socket.template", {
+		"###SERVICE_NAME###" : serviceName,
+		"###ADDRESS###" : constants.SOCKET_LISTEN_ADDRESS,
+		"###PORT###" : str(port),
+		"###BACKLOG###" : str(constants.SOCKET_BACKLOG)
+	})
+
+# Everything that determines whether a service must be restarted
+def getServiceState(appInfo, port, unit):
+	state = {
+		"port" : port,
+		"unitHash" : hashlib.sha256(unit.encode()).hexdigest(),
+		"releaseHash" : appInfo["releaseHash"],
+		"runtimeVersion" : runtimeInstalledVersions[appInfo["runtime"]]
+	}
+	state["fingerprint"] = hashlib.sha256((state["unitHash"] + state["releaseHash"] + state["runtimeVersion"]).encode()).hexdigest()
+	return state
+
+def getRestartReasons(previousState, state):
+	if not previousState:
+		return ["new service"]
+	
+	reasons = []
+	
+	if state["releaseHash"] != previousState["releaseHash"]:
+		reasons.append("app release changed")
+	
+	if state["runtimeVersion"] != previousState["runtimeVersion"]:
+		reasons.append("runtime version changed from " + previousState["runtimeVersion"] + " to " + state["runtimeVersion"])
+	
+	if len(reasons) == 0:
+		reasons.append("unit file changed")
+	
+	return reasons
 
 # Find existing systemd service units
-previousServices = set([os.path.basename(f) for f in glob.glob("/etc/systemd/system/" + constants.TOOL_NAME_LOWERCASE + "*")])
+report.phase("write service units")
+previousServices = set([os.path.basename(f) for f in glob.glob("/etc/systemd/system/" + constants.TOOL_NAME_LOWERCASE + "*.service")])
+previousServiceStates = localConf.get("services", {})
 currentServices = set()
+serviceStates = {}
+restartReasons = {}
+
+# Blue/green: a changed instance of a blueGreen app is started as a new service, in the other slot, alongside the old
+# one. Keyed by the new service name, the old service that it replaces, which is only stopped once nginx has been
+# switched over to the new one.
+replacedServices = {}
+
+# Socket activation: each instance of a socketActivation app has a .socket unit that owns its listening socket, on a
+# port that stays the same across deploys. Restarting the service leaves the socket open, so new connections queue in
+# the kernel until the new process accepts them, rather than being refused. Such apps are never replaced blue/green.
+previousSockets = set([os.path.basename(f) for f in glob.glob("/etc/systemd/system/" + constants.TOOL_NAME_LOWERCASE + "*.socket")])
+previousSocketPorts = localConf.get("socketPorts", {})
+usedSocketPorts = set(previousSocketPorts.values())
+socketPorts = {}
+socketUnits = {}
+nextSocketPort = constants.SOCKET_PORT_START
+
+def getSocketPort(socketName):
+	global nextSocketPort
+	
+	if socketName in previousSocketPorts:
+		socketPorts[socketName] = previousSocketPorts[socketName]
+	else:
+		while nextSocketPort in usedSocketPorts:
+			nextSocketPort += 1
+		
+		assert nextSocketPort < constants.SOCKET_PORT_END, "No ports left for socket activated instances"
+		socketPorts[socketName] = nextSocketPort
+		usedSocketPorts.add(nextSocketPort)
+	
+	reservedPorts.add(socketPorts[socketName])
+	return socketPorts[socketName]
+
+# A service's unit, and its unit together with its socket's unit if it has one, as a whole for fingerprinting
+def buildInstanceUnits(appInfo, instanceNum, port):
+	serviceUnit = buildServiceUnit(appInfo, instanceNum, port)
+	
+	if appInfo["socketActivation"]:
+		socketName = getSocketName(getServiceName(appInfo["deploymentName"], appInfo["appName"], instanceNum))
+		socketUnits[socketName] = buildSocketUnit(socketName[:-len(".socket")] + ".service", port)
+		return serviceUnit, serviceUnit + socketUnits[socketName]
+	
+	return serviceUnit, serviceUnit
+
+# First pass over all server app instances. A service whose unit would be identical using its previous port, with
+# the same release and runtime, is unchanged and is left running as it is.
+changedInstances = []
+reservedPorts = set()
 
-# Create systemd service units for all server apps
 for appInfo in allApps:
 	if not appInfo["isWebApp"]:
-		# Create one or more service instances
+		appInfo["ports"] = [None] * appInfo["instanceCount"]
+		appInfo["notReadyPorts"] = set()
+		
 		for i in range(appInfo["instanceCount"]):
-			serviceName = getServiceName(appInfo["deploymentName"], appInfo["appName"], i)
-			runtimeName, runtimeVersion = splitRuntimeVersion(appInfo["runtime"])
-			runtime = runtimes[runtimeName]
+			# The instance may currently be running in either slot
+			previousServiceName = None
+			previousState = None
 			
-			workingDirectory = getAppInstalledPath(newInstallDir, appInfo)
-			mainScriptPath = workingDirectory + "/" + appInfo["main"]
+			for slot in constants.SERVICE_SLOTS:
+				serviceName = getServiceName(appInfo["deploymentName"], appInfo["appName"], i, slot)
+				
+				if serviceName in previousServices and serviceName in previousServiceStates:
+					previousServiceName = serviceName
+					previousState = previousServiceStates[serviceName]
+					break
 			
-			systemdConfig = fromTemplate("systemd-service.template", {
-				"###USER###" : appInfo["username"],
-				"###PORT###" : str(appInfo["portRangeStart"] + i),
-				"###APP_DATA_DIR###" : appInfo["dataDir"],
-				"###APP_LOG_DIR###" : appInfo["logDir"],
-				"###APP_TEMP_DIR###" : getAppTempDir(appInfo["deploymentName"], appInfo["username"]),
-				"###ENVIRONMENT###" : formatEnvForSystemd({
-					# Use env vars from the runtime and also the app.json
-					# app.json having precedence
-					**runtime.getEnv(runtimeVersion),
-					**appInfo["env"]
-				}),
-				"###WORKING_DIRECTORY###" : workingDirectory,
-				"###EXEC_CMD###" : runtime.getRunCommand(mainScriptPath, runtimeVersion)
-			})
+			if appInfo["socketActivation"]:
+				socketPort = getSocketPort(getSocketName(getServiceName(appInfo["deploymentName"], appInfo["appName"], i)))
+			
+			if previousState:
+				if appInfo["unixSocket"]:
+					# Kept if unchanged, a new path otherwise (also when it was previously listening on a port)
+					if isinstance(previousState["port"], str):
+						port = previousState["port"]
+					else:
+						port = getUnixSocketPath(appInfo, previousServiceName, unixSocketGeneration)
+				elif appInfo["socketActivation"]:
+					port = socketPort
+				else:
+					port = previousState["port"]
+				
+				serviceUnit, instanceUnits = buildInstanceUnits(appInfo, i, port)
+				state = getServiceState(appInfo, port, instanceUnits)
+				
+				if state["fingerprint"] == previousState["fingerprint"]:
+					appInfo["ports"][i] = port
+					reservedPorts.add(port)
+					currentServices.add(previousServiceName)
+					serviceStates[previousServiceName] = state
+					continue
+			
+			if appInfo["socketActivation"]:
+				serviceName = getServiceName(appInfo["deploymentName"], appInfo["appName"], i) # paired with its socket by name
+			elif previousState and appInfo["blueGreen"]:
+				serviceName = getServiceName(appInfo["deploymentName"], appInfo["appName"], i, getOtherServiceSlot(previousServiceName))
+				replacedServices[serviceName] = previousServiceName
+				reservedPorts.add(previousState["port"]) # still in use until the new service takes over
+			else:
+				serviceName = previousServiceName or getServiceName(appInfo["deploymentName"], appInfo["appName"], i)
 			
-			Path("/etc/systemd/system/" + serviceName).write_text(systemdConfig)
 			currentServices.add(serviceName)
+			changedInstances.append((appInfo, i, serviceName, previousState))
+
+# Second pass, changed or new services get new ports (from the new port range) and have their units rendered
+# Except those listening on unix domain sockets, which have a socket path instead, and socket activated ones, which
+# keep the port of their socket. Any socket unit that is new or changed must be
+# (re)started before its service.
+changedSockets = set()
+unitFiles = {}
+
+for appInfo, i, serviceName, previousState in changedInstances:
+	if appInfo["unixSocket"]:
+		port = getUnixSocketPath(appInfo, serviceName, unixSocketGeneration)
+	elif appInfo["socketActivation"]:
+		port = socketPorts[getSocketName(serviceName)]
+	else:
+		while portIndex in reservedPorts:
+			portIndex += 1
+		
+		port = portIndex
+		portIndex += 1
+		assert port < constants.SOCKET_PORT_START, "No ports left for server app instances"
+	
+	serviceUnit, instanceUnits = buildInstanceUnits(appInfo, i, port)
+	state = getServiceState(appInfo, port, instanceUnits)
+	
+	appInfo["ports"][i] = port
+	serviceStates[serviceName] = state
+	restartReasons[serviceName] = getRestartReasons(previousState, state)
+	
+	unitFiles[serviceName] = serviceUnit
+	
+	if appInfo["socketActivation"]:
+		socketName = getSocketName(serviceName)
+		
+		if socketName not in previousSockets or Path("/etc/systemd/system/" + socketName).read_text() != socketUnits[socketName]:
+			changedSockets.add(socketName)
+			unitFiles[socketName] = socketUnits[socketName]
+
+# Before any service is touched, the nginx config for the new ports is built and tested, so that if nginx won't accept
+# it the install fails with everything left as it was. It's only installed once the services have been probed.
+report.phase("test nginx config")
+nginxIncludeFiles = buildNginxConf(thingsByDomain)
+nginxCandidate = prepareNginxConf(nginxIncludeFiles, letsencryptThumbprint)
+
+for unitName, unit in unitFiles.items():
+	Path("/etc/systemd/system/" + unitName).write_text(unit)
 
-# Remove no longer present services
+# Remove no longer present services, except those replaced blue/green which are still serving requests for now
+# systemctl calls are batched, with --no-reload and then a single daemon-reload once all unit files are in place
 
-servicesToRemove = previousServices - currentServices
+report.phase("systemctl")
+servicesToRemove = previousServices - currentServices - set(replacedServices.values())
+servicesToRestart = set(restartReasons.keys())
+systemctlTime = 0
+
+for serviceName in sorted(servicesToRemove):
+	print(f"Removing {serviceName}")
+
+systemctlTime += systemctlBatch(["disable", "--no-reload"], servicesToRemove)
+systemctlTime += systemctlBatch(["--no-block", "stop"], servicesToRemove) # no-blocking for graceful stop
 
 for serviceName in servicesToRemove:
-	runCommand(["systemctl", "disable", serviceName])
-	runCommand(["systemctl", "--no-block", "stop", serviceName]) # no-blocking for graceful stop
 	os.remove("/etc/systemd/system/" + serviceName)
 
-# Enable and (re)start desired services
+# Sockets of removed socket activated services (or of apps no longer socket activated)
+socketsToRemove = previousSockets - set(socketUnits.keys())
+systemctlTime += systemctlBatch(["disable", "--no-reload"], socketsToRemove)
+systemctlTime += systemctlBatch(["stop"], socketsToRemove)
+
+for socketName in socketsToRemove:
+	os.remove("/etc/systemd/system/" + socketName)
+
+if len(servicesToRemove) > 0 or len(servicesToRestart) > 0 or len(socketsToRemove) > 0:
+	startTime = time.monotonic()
+	runCommand(["systemctl", "daemon-reload"])
+	systemctlTime += time.monotonic() - startTime
+
+# Enable and (re)start only new or changed services
 # (we need restart for existing units, and it appears to work for starting new units too...)
-for serviceName in currentServices:
-	runCommand(["systemctl", "enable", serviceName])
-	runCommand(["systemctl", "--no-block", "restart", serviceName])
+for serviceName, reasons in sorted(restartReasons.items()):
+	print(f"Restarting {serviceName}: " + ", ".join(reasons) + (" (blue/green)" if serviceName in replacedServices else ""))
+
+# A changed socket can only be restarted while its service is stopped, though this is rare as socket units rarely change
+systemctlTime += systemctlBatch(["stop"], [
+	socketName[:-len(".socket")] + ".service" for socketName in changedSockets if socketName in previousSockets
+])
+systemctlTime += systemctlBatch(["enable", "--no-reload"], changedSockets)
+systemctlTime += systemctlBatch(["restart"], changedSockets)
+
+systemctlTime += systemctlBatch(["enable", "--no-reload"], servicesToRestart)
+systemctlTime += systemctlBatch(["--no-block", "restart"], servicesToRestart)
+
+print(f"Restarted {len(servicesToRestart)} services, left {len(currentServices) - len(servicesToRestart)} unchanged services running")
+
+# Probe all restarted services until they're ready, before nginx is switched over to them
+# Those of apps that aren't probed are taken as ready.
+report.phase("probe services")
+probeResults = probeInstances([
+	{"service" : serviceName, "port" : serviceStates[serviceName]["port"], **appInfo["healthCheck"]}
+	for appInfo, i, serviceName, previousState in changedInstances if appInfo["probed"]
+], readyTimeout if readyTimeout > 0 else constants.READY_TIMEOUT)
+printProbeResults(probeResults)
+
+def isReady(serviceName):
+	return serviceName not in probeResults or probeResults[serviceName]["ready"]
+
+# If any new blue/green instance of an app isn't ready, the app is rolled back to its old services, which were never
+# stopped.
+rolledBackServices = set()
+
+if len(replacedServices) > 0:
+	notReadyApps = set([
+		id(appInfo) for appInfo, i, serviceName, previousState in changedInstances
+		if serviceName in replacedServices and not isReady(serviceName)
+	])
+	
+	for appInfo, i, serviceName, previousState in changedInstances:
+		if serviceName in replacedServices and id(appInfo) in notReadyApps:
+			rolledBackServices.add(serviceName)
+			oldServiceName = replacedServices.pop(serviceName)
+			appInfo["ports"][i] = previousState["port"]
+			serviceStates[oldServiceName] = previousState
+			del serviceStates[serviceName]
+			currentServices.discard(serviceName)
+			currentServices.add(oldServiceName)
+			servicesToRestart.discard(serviceName)
+	
+	if len(rolledBackServices) > 0:
+		print("Not ready, keeping the old services of their apps instead: " + str(sorted(rolledBackServices)))
+		systemctlTime += systemctlBatch(["disable", "--no-reload"], rolledBackServices)
+		systemctlTime += systemctlBatch(["stop"], rolledBackServices)
+		
+		for serviceName in rolledBackServices:
+			os.remove("/etc/systemd/system/" + serviceName)
+
+# Any other instances that aren't ready are only tried by nginx now and then, while at least one instance is ready
+notReadyServices = []
+
+for appInfo, i, serviceName, previousState in changedInstances:
+	if serviceName not in rolledBackServices and not isReady(serviceName):
+		appInfo["notReadyPorts"].add(appInfo["ports"][i])
+		notReadyServices.append(serviceName)
+
+# THEN, install the nginx config!
+# Only tested again if probing changed it, with instances rolled back or left out as not ready
+report.phase("nginx config")
+probedIncludeFiles = buildNginxConf(thingsByDomain)
+
+if probedIncludeFiles != nginxIncludeFiles:
+	nginxCandidate = prepareNginxConf(probedIncludeFiles, letsencryptThumbprint)
+
+if nginxCandidate is not None:
+	installNginxConf(nginxCandidate)
+
+# Then, reload nginx, only if needed so that its workers and caches aren't needlessly restarted
+# Blocking if old services are to be drained, so that they're only stopped once nginx has switched over
+if nginxCandidate is None:
+	print("nginx config unchanged, not reloading nginx")
+elif len(replacedServices) > 0:
+	runCommand(["systemctl", "reload", "nginx"])
+else:
+	runCommand(["systemctl", "--no-block", "reload", "nginx"])
+
+# Drain the old services replaced blue/green. Requests already sent to them by the old nginx workers are given time to
+# finish, then they're stopped gracefully.
+if len(replacedServices) > 0:
+	report.phase("drain replaced services")
+	oldServices = set(replacedServices.values())
+	print(f"Draining {len(oldServices)} replaced services")
+	time.sleep(constants.BLUE_GREEN_DRAIN_DELAY)
+	
+	systemctlTime += systemctlBatch(["disable", "--no-reload"], oldServices)
+	systemctlTime += systemctlBatch(["--no-block", "stop"], oldServices)
+	
+	for serviceName in oldServices:
+		os.remove("/etc/systemd/system/" + serviceName)
+
+if len(replacedServices) > 0 or len(rolledBackServices) > 0:
+	startTime = time.monotonic()
+	runCommand(["systemctl", "daemon-reload"])
+	systemctlTime += time.monotonic() - startTime
+
+print(f"systemctl took {systemctlTime:.2f}s in total")
+
+# Only now that everything succeeded, remember the state of the services for next time
+localConf.set("services", serviceStates)
+localConf.set("socketPorts", socketPorts)
+
+# Remove everything in the installed apps dir that isn't a currently installed app release
+# This also removes old style (/randomId/deploymentName/appName) install dirs
+def purgeOldInstalls(dirPath, installedPaths, depth = 0):
+	for dirent in os.scandir(dirPath):
+		if depth < 2 and any(path.startswith(dirent.path + "/") for path in installedPaths):
+			purgeOldInstalls(dirent.path, installedPaths, depth + 1)
+		elif dirent.path not in installedPaths:
+			shutil.rmtree(dirent.path)
+
+# Finally, purge the old installs!
+report.phase("purge old installs")
+installedPaths = set([getAppInstalledPath(appInfo) for appInfo in allApps])
+
+# Old releases still used by services being drained, or kept after failing to start blue/green, stay until next time
+for appInfo, i, serviceName, previousState in changedInstances:
+	if serviceName in replacedServices or serviceName in rolledBackServices:
+		installedPaths.add(getAppInstalledPath(appInfo, previousState["releaseHash"]))
+
+purgeOldInstalls(constants.HOSTSERVER_INSTALLED_APPS_DIR, installedPaths)
+
+# And any stored files that were only used by the old installs
+print(f"Purged {fileStore.purgeUnused()} unused files from the file store")
 
+# And the response caches of apps that no longer have one, now that nginx has been reloaded without them
+purgeProxyCacheDirs(probedIncludeFiles)
 
-# THEN, create nginx config!
-nginxConf = buildNginxConf(newInstallDir, thingsByDomain, letsencryptThumbprint)
+report.printForControl({"probes" : probeResults})
 
-# (Don't write it unless the conf building actually succeeded above)
-with open(constants.NGINX_CONF_PATH, "w") as fp:
-	fp.write(nginxConf)
+if len(rolledBackServices) > 0:
+	print("Blue/green services not ready, their apps were not updated: " + str(sorted(rolledBackServices)))
 
-# Then, reload nginx!
-runCommand(["systemctl", "--no-block", "reload", "nginx"])
+# Only fails the install if waiting for services to be ready was asked for, e.g. by a rolling deploy
+if readyTimeout > 0 and len(notReadyServices) > 0:
+	print("Services not ready after " + str(readyTimeout) + "s: " + str(sorted(notReadyServices)))
 
-# Finally, purge the old install dir(s)!
-for dir in oldInstallDirs:
-	shutil.rmtree(constants.HOSTSERVER_INSTALLED_APPS_DIR + "/" + dir)
+if len(rolledBackServices) > 0 or (readyTimeout > 0 and len(notReadyServices) > 0):
+	sys.exit(1)
@@ -0,0 +1,85 @@
+import asyncio, time
+import constants
+
+# Readiness probes of server app instances, run on the host after they are (re)started
+# Every instance is probed at the same time, repeatedly until it's ready or the timeout passes. An instance is ready once
+# its port accepts connections, or if its app has a healthCheck path, once that path returns a 2xx or 3xx status.
+
+class ProbeError(Exception):
+	pass
+
+# port is a unix domain socket path, for an instance listening on one
+async def probeOnce(port, path):
+	if isinstance(port, str):
+		connecting = asyncio.open_unix_connection(port)
+	else:
+		connecting = asyncio.open_connection("localhost", port)
+	
+	reader, writer = await asyncio.wait_for(connecting, constants.PROBE_ATTEMPT_TIMEOUT)
+
+	try:
+		if path:
+			writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+			await writer.drain()
+			statusLine = await asyncio.wait_for(reader.readline(), constants.PROBE_ATTEMPT_TIMEOUT)
+			statusParts = statusLine.split()
+
+			if len(statusParts) < 2 or not statusParts[1].isdigit():
+				raise ProbeError("invalid response")
+
+			status = int(statusParts[1])
+
+			if status < 200 or status >= 400:
+				raise ProbeError(f"status {status}")
+	finally:
+		writer.close()
+
+async def probeUntilReady(instance, startTime, deadline, semaphore):
+	lastError = None
+
+	while True:
+		try:
+			async with semaphore:
+				await probeOnce(instance["port"], instance.get("path"))
+
+			return {"ready" : True, "latency" : round(time.monotonic() - startTime, 3)}
+		except (OSError, asyncio.TimeoutError, ProbeError) as error:
+			lastError = str(error) or type(error).__name__
+
+		if time.monotonic() >= deadline:
+			return {"ready" : False, "latency" : None, "error" : lastError}
+
+		await asyncio.sleep(constants.PROBE_INTERVAL)
+
+async def probeAll(instances, timeout):
+	startTime = time.monotonic()
+	deadline = startTime + timeout
+	semaphore = asyncio.Semaphore(constants.PROBE_CONCURRENCY)
+	results = await asyncio.gather(*[probeUntilReady(instance, startTime, deadline, semaphore) for instance in instances])
+	return {instance["service"] : result for instance, result in zip(instances, results)}
+
+# Probe instances, each a dict of service (name), port, and optionally an HTTP path and slowAfter (seconds)
+# Returns a result for each service: whether it became ready within timeout seconds, how long that took (as latency,
+# measured from when probing started, i.e. just after the services were started), and whether that was slow.
+def probeInstances(instances, timeout):
+	if len(instances) == 0:
+		return {}
+
+	results = asyncio.run(probeAll(instances, timeout))
+
+	for instance in instances:
+		result = results[instance["service"]]
+		result["port"] = instance["port"]
+		result["slow"] = result["ready"] and result["latency"] > instance.get("slowAfter", constants.PROBE_SLOW_AFTER)
+
+	return results
+
+def printProbeResults(results):
+	readyCount = len([result for result in results.values() if result["ready"]])
+	print(f"{readyCount} of {len(results)} probed services are ready")
+
+	for serviceName, result in sorted(results.items()):
+		if not result["ready"]:
+			print(f"Not ready: {serviceName} on port {result['port']} ({result['error']})")
+		elif result["slow"]:
+			print(f"Slow to start: {serviceName} took {result['latency']:.1f}s")
@@ -0,0 +1,128 @@
+import asyncio, time, random
+import constants
+from errors import HostOperationError
+
+# Runs operations on hosts (ssh commands, rsyncs) with a limit on how many run at once, both in total and per host.
+# Failed attempts are retried with exponential backoff and jitter, each attempt has a timeout, and nothing is started
+# once the deadline of the whole deploy has passed. An operation that can't succeed raises HostOperationError rather
+# than retrying forever, and the outcome of every operation is recorded per host.
+class HostScheduler:
+	def __init__(self):
+		self.configure()
+		self.results = {}
+
+	def configure(self,
+		concurrency = constants.HOST_OPERATIONS_CONCURRENCY,
+		perHostConcurrency = constants.HOST_OPERATIONS_PER_HOST_CONCURRENCY,
+		attempts = constants.HOST_OPERATION_ATTEMPTS,
+		timeout = constants.HOST_OPERATION_TIMEOUT,
+		deployTimeout = constants.DEPLOY_TIMEOUT
+	):
+		self.concurrency = concurrency
+		self.perHostConcurrency = perHostConcurrency
+		self.attempts = attempts
+		self.timeout = timeout
+		self.deadline = time.monotonic() + deployTimeout
+
+		# Created when first used, so that they belong to the running event loop
+		self.globalSemaphore = None
+		self.hostSemaphores = {}
+
+	# From a hostOperations block of the deploy config, any keys omitted keep their defaults
+	def configureFromConfig(self, config):
+		self.configure(**{
+			keyName : config[keyName] for keyName in ["concurrency", "perHostConcurrency", "attempts", "timeout", "deployTimeout"]
+			if keyName in config
+		})
+
+	def getGlobalSemaphore(self):
+		if self.globalSemaphore is None:
+			self.globalSemaphore = asyncio.Semaphore(self.concurrency)
+
+		return self.globalSemaphore
+
+	def getHostSemaphore(self, host):
+		if host not in self.hostSemaphores:
+			self.hostSemaphores[host] = asyncio.Semaphore(self.perHostConcurrency)
+
+		return self.hostSemaphores[host]
+
+	def getHostResult(self, host):
+		if host not in self.results:
+			self.results[host] = {"succeeded" : 0, "failed" : 0, "retries" : 0, "duration" : 0, "lastError" : None}
+
+		return self.results[host]
+
+	def getRemainingTime(self):
+		return self.deadline - time.monotonic()
+
+	# Exponential, with half of it random so that many hosts failing together don't all retry together
+	def getBackoff(self, attempt):
+		backoff = min(constants.HOST_OPERATION_BACKOFF_BASE * 2 ** (attempt - 1), constants.HOST_OPERATION_BACKOFF_MAX)
+		return backoff / 2 + random.uniform(0, backoff / 2)
+
+	# Run an operation on a host, returning its result
+	# startOperation is called to start each attempt, and must return an awaitable. Only exceptions in retryOn cause
+	# another attempt, anything else is raised as it is.
+	async def run(self, host, name, startOperation, retryOn = (Exception,), timeout = None):
+		result = self.getHostResult(host)
+		startTime = time.monotonic()
+		attempt = 1
+
+		try:
+			while True:
+				attemptTimeout = min(timeout or self.timeout, self.getRemainingTime())
+
+				if attemptTimeout <= 0:
+					raise HostOperationError(host, name, "was not started, the deploy deadline has passed")
+
+				async with self.getHostSemaphore(host), self.getGlobalSemaphore():
+					attemptStartTime = time.monotonic()
+
+					try:
+						value = await asyncio.wait_for(startOperation(), attemptTimeout)
+						result["succeeded"] += 1
+						return value
+					except asyncio.TimeoutError as error:
+						# Timed out by us rather than by the operation itself. Not retried, it may well take as long again.
+						if time.monotonic() - attemptStartTime >= attemptTimeout:
+							raise HostOperationError(host, name, f"timed out after {attemptTimeout:.0f}s") from error
+
+						if not isinstance(error, retryOn):
+							raise
+
+						failure = error
+					except retryOn as error:
+						failure = error
+
+				if attempt >= self.attempts:
+					raise HostOperationError(host, name, f"failed after {attempt} attempts: {failure}") from failure
+
+				backoff = min(self.getBackoff(attempt), max(self.getRemainingTime(), 0))
+				print(f"{name} on {host} failed ({failure}), will retry in {backoff:.1f}s...")
+				result["retries"] += 1
+				attempt += 1
+				await asyncio.sleep(backoff)
+		except Exception as error:
+			result["failed"] += 1
+			result["lastError"] = str(error)
+			raise
+		finally:
+			result["duration"] = round(result["duration"] + time.monotonic() - startTime, 3)
+
+	def printResults(self):
+		if len(self.results) == 0:
+			return
+
+		hostWidth = max([len("host")] + [len(host) for host in self.results])
+		print("host".ljust(hostWidth) + "  succeeded  failed  retries   time  last error")
+
+		for host, result in sorted(self.results.items()):
+			print(
+				host.ljust(hostWidth)
+				+ f"  {result['succeeded']:9}  {result['failed']:6}  {result['retries']:7}  {result['duration']:5.0f}s"
+				+ f"  {result['lastError'] or ''}"
+			)
+
+# Shared by everything run during this process
+hostScheduler = HostScheduler()
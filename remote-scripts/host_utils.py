@@ -1,6 +1,9 @@
-import os, importlib, hashlib
+import os, importlib, hashlib, time, re, math, glob
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import constants
+from utils import runCommand
+from errors import TemplateError
 
 def getCertPrivkeyPath(domain):
 	return constants.HOSTSERVER_CERTS_DIR + "/" + domain + ".key.pem"
@@ -8,11 +11,32 @@ def getCertPrivkeyPath(domain):
 def getCertFullchainPath(domain):
 	return constants.HOSTSERVER_CERTS_DIR + "/" + domain + ".fullchain.pem"
 
+TEMPLATE_PLACEHOLDER_REGEX = re.compile(r"(###[A-Z0-9_]+###)")
+
+# Templates, once read, split into alternating literal text and placeholders, and the set of their placeholders
+compiledTemplates = {}
+
+def compileTemplate(templateName):
+	if templateName not in compiledTemplates:
+		template = Path(constants.HOSTSERVER_SCRIPTS_DIR + "/templates/" + templateName).read_text()
+		parts = TEMPLATE_PLACEHOLDER_REGEX.split(template) # odd indices are placeholders
+		compiledTemplates[templateName] = (parts, frozenset(parts[1::2]))
+	
+	return compiledTemplates[templateName]
+
+# Render a template in a single pass, so substituted text is never itself substituted
+# Every placeholder of the template must be given a substitution, and every substitution must be used.
 def fromTemplate(templateName, substitutions):
-	template = Path(constants.HOSTSERVER_SCRIPTS_DIR + "/templates/" + templateName).read_text()
-	for original, replacement in substitutions.items():
-	    template = template.replace(original, replacement)
-	return template
+	parts, placeholders = compileTemplate(templateName)
+	
+	if substitutions.keys() != placeholders:
+		missing = sorted(placeholders - substitutions.keys())
+		unknown = sorted(substitutions.keys() - placeholders)
+		raise TemplateError(templateName, missing, unknown)
+	
+	rendered = parts.copy()
+	rendered[1::2] = [substitutions[placeholder] for placeholder in parts[1::2]]
+	return "".join(rendered)
 
 def loadRuntimes():
 	runtimes = {}
@@ -25,8 +49,14 @@ def loadRuntimes():
 	
 	return runtimes
 
-def getAppInstalledPath(newInstallDir, appInfo):
-	return newInstallDir + "/" + appInfo["deploymentName"] + "/" + appInfo["appName"]
+# Dir containing the installed release(s) of an app
+def getAppInstallDir(appInfo):
+	return constants.HOSTSERVER_INSTALLED_APPS_DIR + "/" + appInfo["deploymentName"] + "/" + appInfo["appName"]
+
+# Installed releases are named after the hash of their release tree
+# Path of the current release, or of an earlier one if given
+def getAppInstalledPath(appInfo, releaseHash = None):
+	return getAppInstallDir(appInfo) + "/" + (releaseHash or appInfo["releaseHash"])[:32]
 
 def getAppLogDir(deploymentName, appName, username):
 	return constants.HOSTSERVER_APP_LOG_DIR + "/" + deploymentName + "/" + appName + "/" + username
@@ -37,11 +67,219 @@ def getAppDataDir(deploymentName, username):
 def getAppTempDir(deploymentName, username):
 	return constants.HOSTSERVER_APP_TEMP_DIR + "/" + deploymentName + "/" + username
 
-def getInstanceCount(instancesPerCPU):
-	return instancesPerCPU * os.cpu_count() if instancesPerCPU > 0 else 1
+# Parse a list of CPUs as in /sys, e.g. "0-3,8-11"
+def parseCPUList(cpuList):
+	cpus = []
+	
+	for part in cpuList.strip().split(","):
+		if "-" in part:
+			first, last = part.split("-")
+			cpus.extend(range(int(first), int(last) + 1))
+		elif part:
+			cpus.append(int(part))
+	
+	return cpus
+
+def readFileOrNone(filePath):
+	try:
+		return Path(filePath).read_text().strip()
+	except (FileNotFoundError, PermissionError):
+		return None
+
+# The CPU limit of cgroup quotas on services, as a number of CPUs, or None if there isn't one
+# Services run in system.slice, and the host itself may be a container with a quota on its root cgroup.
+def getCgroupCPULimit():
+	limits = []
+	
+	for cgroupDir in ["/sys/fs/cgroup", "/sys/fs/cgroup/system.slice"]:
+		cpuMax = readFileOrNone(cgroupDir + "/cpu.max") # cgroup v2, "quota period" or "max period"
+		
+		if cpuMax and not cpuMax.startswith("max"):
+			quota, period = cpuMax.split()
+			limits.append(int(quota) / int(period))
+	
+	quota = readFileOrNone("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") # cgroup v1, -1 for none
+	period = readFileOrNone("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+	
+	if quota and period and int(quota) > 0:
+		limits.append(int(quota) / int(period))
+	
+	return min(limits) if len(limits) > 0 else None
+
+# The CPUs services may run on, i.e. this process's CPU affinity, which excludes any CPUs isolated or not in its cpuset
+def getAvailableCPUs():
+	return sorted(os.sched_getaffinity(0))
+
+# How many CPUs' worth of time services can actually use, also taking any cgroup quota into account
+def getAvailableCPUCount():
+	cpuCount = len(getAvailableCPUs())
+	cgroupLimit = getCgroupCPULimit()
+	
+	if cgroupLimit is not None:
+		cpuCount = min(cpuCount, max(1, math.ceil(cgroupLimit)))
+	
+	return cpuCount
+
+# Available CPUs of each NUMA node, {node number : [cpus]}
+# A machine without NUMA (or without /sys) is treated as a single node.
+def getNUMANodes():
+	availableCPUs = set(getAvailableCPUs())
+	nodes = {}
+	
+	for nodeDir in glob.glob("/sys/devices/system/node/node[0-9]*"):
+		cpus = [cpu for cpu in parseCPUList(readFileOrNone(nodeDir + "/cpulist") or "") if cpu in availableCPUs]
+		
+		if len(cpus) > 0:
+			nodes[int(nodeDir[len("/sys/devices/system/node/node"):])] = cpus
+	
+	return nodes if len(nodes) > 0 else {0 : sorted(availableCPUs)}
+
+# Instances of a server app: an absolute number of instances, or a number per available CPU (may be fractional), or
+# otherwise just one. Either way no more than maxInstances, if set.
+def getInstanceCount(appInfo):
+	if appInfo["instances"]:
+		instanceCount = appInfo["instances"]
+	elif appInfo["instancesPerCPU"] > 0:
+		instanceCount = max(1, int(appInfo["instancesPerCPU"] * getAvailableCPUCount()))
+	else:
+		instanceCount = 1
+	
+	if appInfo["maxInstances"]:
+		instanceCount = min(instanceCount, appInfo["maxInstances"])
+	
+	return instanceCount
+
+# systemd settings pinning an instance of a server app to CPUs, from the app's cpuAffinity
+# "core" pins each instance to a CPU of its own, and "numa" to the CPUs and memory of a NUMA node, spreading instances
+# over them in turn. Apps start from a different CPU or node (a stable one, so pinning doesn't change between deploys),
+# so that the first instances of every app on a host don't all share the same CPU.
+def getCPUPinning(appInfo, instanceNum):
+	cpuAffinity = appInfo["cpuAffinity"]
+	
+	if not cpuAffinity:
+		return ""
+	
+	assert cpuAffinity in ["core", "numa"], ("Unknown cpuAffinity " + str(cpuAffinity) + " for app " + appInfo["appName"])
+	offset = int(hashlib.sha256((appInfo["deploymentName"] + "/" + appInfo["appName"]).encode()).hexdigest()[:8], 16)
+	
+	if cpuAffinity == "core":
+		availableCPUs = getAvailableCPUs()
+		return "CPUAffinity=" + str(availableCPUs[(offset + instanceNum) % len(availableCPUs)])
+	else:
+		nodes = getNUMANodes()
+		nodeNums = sorted(nodes.keys())
+		nodeNum = nodeNums[(offset + instanceNum) % len(nodeNums)]
+		return "\n".join([
+			"CPUAffinity=" + " ".join(str(cpu) for cpu in nodes[nodeNum]),
+			"NUMAPolicy=bind",
+			"NUMAMask=" + str(nodeNum)
+		])
 
-def getServiceName(deploymentName, appName, instanceNum):
-	return constants.TOOL_NAME_LOWERCASE + "---" + deploymentName + "---" + appName + "---" + str(instanceNum) + ".service"
+MEMORY_UNITS = {"K" : 1024, "M" : 1024 ** 2, "G" : 1024 ** 3, "T" : 1024 ** 4}
+MEMORY_SIZE_REGEX = re.compile(r"(\d+(\.\d+)?[KMGT%]|\d+|infinity)")
+
+def getHostMemory():
+	return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+# Bytes of a systemd memory setting, e.g. "512M", a number of bytes, or a percentage of the host's memory
+# None for "infinity".
+def parseMemorySize(value, hostMemory):
+	value = str(value).strip()
+	
+	if value == "infinity":
+		return None
+	elif value.endswith("%"):
+		return int(hostMemory * float(value[:-1]) / 100)
+	elif value[-1] in MEMORY_UNITS:
+		return int(float(value[:-1]) * MEMORY_UNITS[value[-1]])
+	else:
+		return int(value)
+
+# systemd resource control settings for each instance of a server app, from the resources block of its appMeta.json
+# Values are checked against this host's resources, so that a typo (e.g. "800G") fails the install rather than giving a
+# limit that can never apply.
+def getResourceControls(appInfo):
+	resources = appInfo["resources"]
+	appName = appInfo["appName"]
+	
+	for keyName in resources:
+		assert keyName in constants.SYSTEMD_RESOURCE_CONTROLS, ("Unknown resources key " + keyName + " for app " + appName)
+	
+	hostMemory = getHostMemory()
+	memory = {}
+	
+	for keyName in ["memoryMax", "memoryHigh"]:
+		if keyName in resources:
+			assert MEMORY_SIZE_REGEX.fullmatch(str(resources[keyName]).strip()), (
+				keyName + " of app " + appName + " must be a number of bytes, a size such as 512M or 1.5G, a percentage, or infinity"
+			)
+			memory[keyName] = parseMemorySize(resources[keyName], hostMemory)
+			assert memory[keyName] is None or 0 < memory[keyName] <= hostMemory, (
+				keyName + " of app " + appName + " is more than this host's memory of " + str(hostMemory // MEMORY_UNITS["M"]) + "M"
+			)
+	
+	if memory.get("memoryMax") and memory.get("memoryHigh"):
+		assert memory["memoryHigh"] <= memory["memoryMax"], ("memoryHigh is more than memoryMax, for app " + appName)
+	
+	if "cpuQuota" in resources: # e.g. "150%" for one and a half CPUs
+		cpuQuota = str(resources["cpuQuota"])
+		assert re.fullmatch(r"\d+(\.\d+)?%", cpuQuota), ("cpuQuota must be a percentage, for app " + appName)
+		assert 0 < float(cpuQuota[:-1]) <= getAvailableCPUCount() * 100, (
+			"cpuQuota of app " + appName + " is more than this host's " + str(getAvailableCPUCount()) + " available CPUs"
+		)
+	
+	for keyName in ["cpuWeight", "ioWeight"]:
+		if keyName in resources:
+			assert str(resources[keyName]).isdigit() and 1 <= int(resources[keyName]) <= 10000, (
+				keyName + " must be from 1 to 10000, for app " + appName
+			)
+	
+	if "tasksMax" in resources and type(resources["tasksMax"]) is int:
+		assert 0 < resources["tasksMax"] <= int(readFileOrNone("/proc/sys/kernel/pid_max")), (
+			"tasksMax of app " + appName + " is more than this host's pid_max"
+		)
+	
+	# A number, "soft:hard", or "infinity"
+	if "limitNOFILE" in resources and str(resources["limitNOFILE"]) != "infinity":
+		limitParts = str(resources["limitNOFILE"]).split(":")
+		assert len(limitParts) <= 2 and all(part.isdigit() for part in limitParts), (
+			"limitNOFILE of app " + appName + " must be a number, soft:hard numbers, or infinity"
+		)
+		assert all(int(part) <= int(readFileOrNone("/proc/sys/fs/nr_open")) for part in limitParts), (
+			"limitNOFILE of app " + appName + " is more than this host's fs.nr_open"
+		)
+	
+	return "\n".join([
+		settingName + "=" + str(resources[keyName])
+		for keyName, settingName in constants.SYSTEMD_RESOURCE_CONTROLS.items() if keyName in resources
+	])
+
+# Each instance has a service in one of two slots, so that a new one can be started alongside the old one (blue/green)
+# The first slot has no suffix, as before blue/green existed.
+def getServiceName(deploymentName, appName, instanceNum, slot = constants.SERVICE_SLOTS[0]):
+	return constants.TOOL_NAME_LOWERCASE + "---" + deploymentName + "---" + appName + "---" + str(instanceNum) + slot + ".service"
+
+# Path of the unix domain socket an instance of a server app listens on, in place of a port
+# Sockets are in their own dir of the app's temp dir, with a name derived from the service name (so that blue/green
+# services have their own) short enough to keep under the path length limit. The generation changes on every install,
+# so that a restarted instance never shares a path with its old process (which may still be listening while stopping).
+def getUnixSocketPath(appInfo, serviceName, generation):
+	socketPath = (
+		getAppTempDir(appInfo["deploymentName"], appInfo["username"]) + "/sockets/"
+		+ hashlib.sha256(serviceName.encode()).hexdigest()[:16] + "-" + str(generation) + ".sock"
+	)
+	assert len(socketPath.encode()) <= constants.UNIX_SOCKET_PATH_MAX, ("Unix socket path too long, for app " + appInfo["appName"])
+	return socketPath
+
+# The .socket unit of a socket activated service, which systemd pairs with the service by name
+def getSocketName(serviceName):
+	return serviceName[:-len(".service")] + ".socket"
+
+def getOtherServiceSlot(serviceName):
+	if serviceName.endswith(constants.SERVICE_SLOTS[1] + ".service"):
+		return constants.SERVICE_SLOTS[0]
+	else:
+		return constants.SERVICE_SLOTS[1]
 
 # Takes a dict and outputs a string containing "Environment=..." statements for a systemd unit file
 def formatEnvForSystemd(env):
@@ -60,3 +298,26 @@ def genDataGroupUserName(deploymentName, dataGroup):
 	# Max 32 chars
 	# "appname:" / "datagroup:" strings prevents any clashes with app names and data groups.
 	return dataGroup[:10] + "_" + hashlib.sha256(("datagroup:" + dataGroup).encode()).hexdigest()[:8] + "_" + hashlib.sha256(deploymentName.encode()).hexdigest()[:8]
+
+# Call function with each item, in a pool of threads, returning the results in order
+# For work that mostly waits on the disk or the kernel (copying, hashing, chown), so that apps are installed at once
+# rather than one after another. Any exception is raised once every call has finished or failed.
+def runInPool(function, items, concurrency = constants.HOST_INSTALL_CONCURRENCY):
+	with ThreadPoolExecutor(max_workers = concurrency) as executor:
+		return list(executor.map(function, items))
+
+# Run a systemctl command on many units using as few systemctl invocations as possible
+# Returns the time taken in seconds
+def systemctlBatch(args, unitNames):
+	unitNames = sorted(unitNames)
+	startTime = time.monotonic()
+	
+	for i in range(0, len(unitNames), constants.SYSTEMCTL_BATCH_SIZE):
+		runCommand(["systemctl"] + args + unitNames[i:i + constants.SYSTEMCTL_BATCH_SIZE])
+	
+	elapsed = time.monotonic() - startTime
+	
+	if len(unitNames) > 0:
+		print(f"systemctl {' '.join(args)} of {len(unitNames)} units took {elapsed:.2f}s")
+	
+	return elapsed
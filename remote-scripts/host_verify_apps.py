@@ -0,0 +1,27 @@
+# Verify that the apps of a deployment on this server match the manifest sent by the control server
+# The control server only sends files that changed since its last sync, this checks nothing else differs.
+import sys, json
+import constants
+from utils import FileHashCache, buildManifest, diffManifests
+
+deploymentName = sys.argv[1]
+assert(len(deploymentName) > 0)
+
+deploymentDir = constants.HOSTSERVER_APPS_DIR + "/" + deploymentName
+
+with open(deploymentDir + "/" + constants.MANIFEST_FILE, "r") as fp:
+	expectedManifest = json.load(fp)
+
+hashCache = FileHashCache(constants.HOSTSERVER_MANIFEST_HASH_CACHE_DIR + "/" + deploymentName + ".json")
+manifest = buildManifest(deploymentDir, hashCache, exclude = [constants.MANIFEST_FILE])
+hashCache.save()
+
+changed, deleted = diffManifests(manifest, expectedManifest)
+
+if len(changed) > 0 or len(deleted) > 0:
+	print(f"Apps of {deploymentName} do not match manifest")
+	print("Differing: " + str(changed))
+	print("Unexpected: " + str(deleted))
+	sys.exit(1)
+
+print(f"Verified {len(manifest)} files and dirs of {deploymentName}")
@@ -0,0 +1,166 @@
+import os, re, json, mmap, hashlib, time, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import constants
+from utils import fastCopyFile
+
+# Injection of env vars into an app's files, replacing ###APPCONTROL_ENV_MYVAR### and ###APPCONTROL_JSON_ENV###
+# placeholders. Each file is scanned once, with all placeholders replaced in a single regex pass, and files without any
+# placeholders that were replaced are never rewritten (so keep their inode, and their hash stays cached). Output is cached by input content and env, so unchanged files are not processed
+# again on the next deploy.
+
+PLACEHOLDER_PREFIX = b"###APPCONTROL_"
+PLACEHOLDER_REGEX = re.compile(rb"###APPCONTROL_(.+?)###")
+
+# Set in each worker process by initWorker
+workerReplacements = None
+workerEnvHash = None
+workerCacheDir = None
+
+def initWorker(replacements, envHash, cacheDir):
+	global workerReplacements, workerEnvHash, workerCacheDir
+	workerReplacements = replacements
+	workerEnvHash = envHash
+	workerCacheDir = cacheDir
+
+def getReplacements(env):
+	replacements = {
+		"###APPCONTROL_ENV_{}###".format(envVar).encode() : envVal.encode() for envVar, envVal in env.items()
+	}
+
+	# also may inject entire env as JSON
+	replacements[b"###APPCONTROL_JSON_ENV###"] = json.dumps(env).encode()
+	return replacements
+
+def findUnmatched(data):
+	return ["###APPCONTROL_{}###".format(match.decode(errors = "replace")) for match in PLACEHOLDER_REGEX.findall(data)]
+
+# Replace filePath with new contents, or with a copy of another file
+def replaceFile(filePath, mode, data = None, copyFrom = None):
+	tempPath = filePath + ".appcontrol-tmp"
+
+	if copyFrom:
+		fastCopyFile(copyFrom, tempPath)
+	else:
+		with open(tempPath, "wb") as f:
+			f.write(data)
+
+	os.chmod(tempPath, mode)
+
+	# Rather than writing in place, as the file may be hardlinked elsewhere
+	os.replace(tempPath, filePath)
+
+# Copied rather than linked, so the cache can never be modified through an app's files
+def addToCache(data, cachePath):
+	os.makedirs(os.path.dirname(cachePath), exist_ok = True)
+	tempPath = cachePath + "." + str(os.getpid()) + ".tmp"
+
+	with open(tempPath, "wb") as f:
+		f.write(data)
+
+	os.replace(tempPath, cachePath)
+
+# Returns (whether file was changed, any unmatched placeholders)
+def injectFile(filePath):
+	fileStat = os.stat(filePath)
+
+	if fileStat.st_size == 0:
+		return False, []
+
+	with open(filePath, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+		if data.find(PLACEHOLDER_PREFIX) == -1:
+			return False, []
+
+		mode = fileStat.st_mode & 0o7777
+		cacheKey = hashlib.sha256(data).hexdigest() + "-" + workerEnvHash + "-" + format(mode, "o")
+		cachePath = workerCacheDir + "/" + cacheKey[:2] + "/" + cacheKey
+
+		if os.path.isfile(cachePath):
+			os.utime(cachePath) # Mark as recently used
+
+			with open(cachePath, "rb") as cachedFile:
+				cachedData = cachedFile.read()
+
+			# Only unmatched placeholders
+			if len(cachedData) == len(data) and cachedData == data[:]:
+				return False, findUnmatched(cachedData)
+
+			replaceFile(filePath, mode, data = cachedData)
+			return True, findUnmatched(cachedData)
+
+		unmatched = []
+
+		def substitute(match):
+			replacement = workerReplacements.get(match.group(0))
+
+			if replacement is None:
+				unmatched.append(match.group(0).decode(errors = "replace"))
+				return match.group(0)
+
+			return replacement
+
+		newData, matchCount = PLACEHOLDER_REGEX.subn(substitute, data)
+
+	addToCache(newData, cachePath)
+
+	if matchCount == len(unmatched):
+		return False, unmatched
+
+	replaceFile(filePath, mode, data = newData)
+	return True, unmatched
+
+def findFiles(dirPath, testRegex, filePaths):
+	for dirent in os.scandir(dirPath):
+		if dirent.is_dir():
+			# Recurse
+			findFiles(dirent.path, testRegex, filePaths)
+		elif dirent.is_file():
+			if re.search(testRegex, dirent.name):
+				filePaths.append(dirent.path)
+
+def fileInjectEnv(dirPath, testRegex, env):
+	filePaths = []
+	findFiles(dirPath, testRegex, filePaths)
+
+	envHash = hashlib.sha256(json.dumps(env, sort_keys = True).encode()).hexdigest()
+	initArgs = (getReplacements(env), envHash, constants.CONTROLSERVER_INJECT_CACHE_DIR)
+
+	if len(filePaths) > 1:
+		# fork, since the deploy script (as __main__) must not be imported again by the workers
+		with ProcessPoolExecutor(
+			mp_context = multiprocessing.get_context("fork"), initializer = initWorker, initargs = initArgs
+		) as executor:
+			results = list(executor.map(injectFile, filePaths, chunksize = 16))
+	else:
+		initWorker(*initArgs)
+		results = [injectFile(filePath) for filePath in filePaths]
+
+	changedCount = 0
+	unmatched = set()
+
+	for changed, fileUnmatched in results:
+		changedCount += changed
+		unmatched.update(fileUnmatched)
+
+	print(f"Injected env into {changedCount} of {len(filePaths)} matching files")
+
+	# Finally, give a warning for any remaining ###APPCONTROL_*###
+	# (an env var probably should have been set)
+	if len(unmatched) > 0:
+		print("Warning: Some ###APPCONTROL template strings were not matched with environmental variables and will remain in deployed app!")
+		print(sorted(unmatched))
+
+# Remove cached files that haven't been used for a while, from a cache dir of two character subdirs
+def pruneCacheDir(cacheDir, maxAge):
+	if not os.path.isdir(cacheDir):
+		return
+
+	oldestAllowed = time.time() - maxAge
+
+	for dirent in os.scandir(cacheDir):
+		for fileDirent in os.scandir(dirent.path):
+			if fileDirent.stat().st_mtime < oldestAllowed:
+				os.remove(fileDirent.path)
+
+# Remove cached output that hasn't been used for a while
+def pruneInjectEnvCache():
+	pruneCacheDir(constants.CONTROLSERVER_INJECT_CACHE_DIR, constants.INJECT_CACHE_MAX_AGE)
@@ -0,0 +1,89 @@
+import os, gzip, hashlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import constants
+from inject_env import findFiles, replaceFile, addToCache, pruneCacheDir
+
+# Precompression of a web app's files at deploy time, so that nginx can serve a .gz (and, if the brotli module is
+# installed on the control server, a .br) file next to each original rather than compressing on every request.
+# Compressed output is cached by input content, so unchanged files are not compressed again on the next deploy.
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Deterministic output (no timestamp in the gzip header), so unchanged files give unchanged .gz files on hosts
+def compressGzip(data):
+	return gzip.compress(data, compresslevel = 9, mtime = 0)
+
+def compressBrotli(data):
+	return brotli.compress(data, quality = 11)
+
+def getCompressors():
+	compressors = [(".gz", compressGzip)]
+
+	if brotli:
+		compressors.append((".br", compressBrotli))
+
+	return compressors
+
+# Returns how many compressed files were written alongside filePath
+def compressFile(filePath):
+	fileStat = os.stat(filePath)
+
+	if fileStat.st_size < constants.PRECOMPRESS_MIN_SIZE:
+		return 0
+
+	with open(filePath, "rb") as f:
+		data = f.read()
+
+	contentHash = hashlib.sha256(data).hexdigest()
+	mode = fileStat.st_mode & 0o7777
+	writtenCount = 0
+
+	for extension, compress in getCompressors():
+		compressedPath = filePath + extension
+
+		# The app may ship its own
+		if os.path.lexists(compressedPath):
+			continue
+
+		cachePath = constants.CONTROLSERVER_PRECOMPRESS_CACHE_DIR + "/" + contentHash[:2] + "/" + contentHash + extension
+
+		if os.path.isfile(cachePath):
+			os.utime(cachePath) # Mark as recently used
+			replaceFile(compressedPath, mode, copyFrom = cachePath)
+			writtenCount += 1
+			continue
+
+		compressedData = compress(data)
+
+		# Not worth it, e.g. an already compressed format
+		if len(compressedData) >= len(data):
+			continue
+
+		replaceFile(compressedPath, mode, data = compressedData)
+		addToCache(compressedData, cachePath)
+		writtenCount += 1
+
+	return writtenCount
+
+# testRegex matches the names of files to compress
+def precompressFiles(dirPath, testRegex):
+	filePaths = []
+	findFiles(dirPath, testRegex, filePaths)
+	filePaths = [filePath for filePath in filePaths if not filePath.endswith((".gz", ".br"))]
+
+	if len(filePaths) > 1:
+		# fork, since the deploy script (as __main__) must not be imported again by the workers
+		with ProcessPoolExecutor(mp_context = multiprocessing.get_context("fork")) as executor:
+			writtenCount = sum(executor.map(compressFile, filePaths, chunksize = 16))
+	else:
+		writtenCount = sum(compressFile(filePath) for filePath in filePaths)
+
+	extensions = ", ".join(extension for extension, compress in getCompressors())
+	print(f"Precompressed {writtenCount} files ({extensions}) from {len(filePaths)} matching files")
+
+# Remove cached output that hasn't been used for a while
+def prunePrecompressCache():
+	pruneCacheDir(constants.CONTROLSERVER_PRECOMPRESS_CACHE_DIR, constants.PRECOMPRESS_CACHE_MAX_AGE)
@@ -1,4 +1,5 @@
 import os
+from subprocess import CalledProcessError
 from utils import runCommand
 
 N_PATH = "/usr/local/bin/n"
@@ -20,6 +21,16 @@ class Runtime:
 			# just ensure latest is installed
 			runCommand(["n", "install", "latest"])
 	
+	# The exact version that will be run, e.g. "latest" resolves to whatever latest was last installed
+	def getInstalledVersion(self, version):
+		if version == None:
+			version = "latest"
+		
+		try:
+			return runCommand(["n", "which", str(version)])
+		except CalledProcessError:
+			return str(version)
+	
 	def getEnv(self, version):
 		return {
 			"NODE_ENV" : "production"
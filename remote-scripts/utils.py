@@ -1,7 +1,8 @@
-import asyncio, sys, subprocess, json, os, re
+import asyncio, sys, subprocess, json, os, re, hashlib, shutil, fcntl
 from subprocess import CalledProcessError
 from errors import HostVerificationError
 import constants
+from host_scheduler import hostScheduler
 
 def getProjectNameAndTarget(deploymentName):
 	return re.match("^(.+)---(.+)$", deploymentName).groups()
@@ -25,9 +26,23 @@ def runCommand(args, addToEnv = None, returnCode = False):
 		completed.check_returncode()
 		return completed.stdout.decode("utf-8").strip()
 
-async def runCommandAsync(argList):
-	proc = await asyncio.create_subprocess_exec(*argList, stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.PIPE)
-	stdout, stderr = await proc.communicate()
+async def runCommandAsync(argList, addToEnv = None):
+	env = None
+
+	if addToEnv:
+		env = os.environ.copy()
+		for key, value in addToEnv.items():
+			env[key] = value
+
+	proc = await asyncio.create_subprocess_exec(*argList, stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.PIPE, env = env)
+	
+	try:
+		stdout, stderr = await proc.communicate()
+	except asyncio.CancelledError:
+		# e.g. timed out, don't leave the process running
+		proc.kill()
+		await proc.wait()
+		raise
 
 	if proc.returncode != 0:
 		print(stderr.decode().strip())
@@ -35,20 +50,18 @@ async def runCommandAsync(argList):
 
 	return stdout.decode().strip()
 
-# Rsync between local directories, synchronously
-def localRsync(sourceDir, destDir, extraArgs = []):
-	return runCommand([
-			"rsync",
-			"-rzl",
-			"--delete",
-			"--checksum"
-		]
-		+ extraArgs
-		+ [sourceDir, destDir]
-	)
+# ssh command for rsync to use. Connections are multiplexed through a persistent master connection per host and key,
+# so that only the first rsync to a host pays for the ssh handshake.
+def getRsyncRemoteShell(keyPath):
+	controlPath = constants.SSH_CONTROL_PATH_PREFIX + hashlib.sha256(keyPath.encode()).hexdigest()[:8] + "-%C"
+	
+	return " ".join([
+		"ssh", "-oBatchMode=yes", "-i", keyPath,
+		"-oControlMaster=auto", "-oControlPath=" + controlPath, "-oControlPersist=" + str(constants.SSH_CONTROL_PERSIST)
+	])
 
-async def _rsyncNoRetry(host, keyPath, sourceDir, destDir, extraArgs = []):
-	remoteShell = "ssh -oBatchMode=yes -i " + keyPath
+async def _rsyncNoRetry(host, keyPath, sourceDir, destDir, extraArgs = [], delete = True, checksum = True):
+	remoteShell = getRsyncRemoteShell(keyPath)
 	dest = "root@[" + host + "]:" + destDir;
 	
 	try:
@@ -56,11 +69,11 @@ async def _rsyncNoRetry(host, keyPath, sourceDir, destDir, extraArgs = []):
 				"rsync",
 				"-rzl",
 				"-e", remoteShell,
-				"--delete",
-				"--checksum",
 				"--timeout=10",
 				"--outbuf=L"
 			]
+			+ (["--delete"] if delete else [])
+			+ (["--checksum"] if checksum else [])
 			+ extraArgs
 			+ [sourceDir, dest]
 		)
@@ -70,16 +83,13 @@ async def _rsyncNoRetry(host, keyPath, sourceDir, destDir, extraArgs = []):
 		else:
 			raise error
 
-# rsync with continuous retry for any CalledProcessError
-async def rsync(host, keyPath, sourceDir, destDir, extraArgs = []):
-	while True:
-		try:
-			await _rsyncNoRetry(host, keyPath, sourceDir, destDir, extraArgs)
-			break
-		except CalledProcessError as error:
-			print(error)
-			print(f"Rsync from master server to {host} failed with code {error.returncode}, will retry...");
-			await asyncio.sleep(5)
+# rsync, retrying with backoff for any CalledProcessError
+# Raises HostOperationError if it can't succeed within the attempts and time allowed by the host scheduler.
+async def rsync(host, keyPath, sourceDir, destDir, extraArgs = [], delete = True, checksum = True):
+	await hostScheduler.run(host, "rsync to " + destDir,
+		lambda: _rsyncNoRetry(host, keyPath, sourceDir, destDir, extraArgs, delete, checksum),
+		retryOn = CalledProcessError
+	)
 
 # Simple on disk key-value store
 class ConfigStore:
@@ -103,3 +113,165 @@ class ConfigStore:
 
 		with open(self.filePath, "w") as f:
 			json.dump(self.data, f)
+
+FICLONE = 0x40049409 # ioctl making a file a reflink of another, sharing its blocks until either is modified
+
+# Copy a file's contents the fastest way its filesystem supports: as a reflink (btrfs, XFS and others), which copies no
+# data at all, or else with copy_file_range, which copies within the kernel rather than through Python. Falls back to
+# shutil.copyfile where neither works, e.g. across filesystems on older kernels.
+def fastCopyFile(sourcePath, destPath):
+	with open(sourcePath, "rb") as source, open(destPath, "wb") as dest:
+		try:
+			fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+			return
+		except OSError:
+			pass
+		
+		try:
+			while os.copy_file_range(source.fileno(), dest.fileno(), 1024 * 1024 * 1024) > 0:
+				pass
+			
+			return
+		except OSError:
+			pass
+	
+	shutil.copyfile(sourcePath, destPath)
+
+# Hardlink a file, e.g. as the copy_function of shutil.copytree, or copy it where it can't be linked (e.g. across
+# filesystems)
+def linkOrCopyFile(sourcePath, destPath):
+	try:
+		os.link(sourcePath, destPath)
+	except OSError:
+		shutil.copy2(sourcePath, destPath)
+
+# sha256 of a file's contents, read in chunks so large files aren't loaded into memory
+def hashFile(filePath):
+	digest = hashlib.sha256()
+
+	with open(filePath, "rb") as f:
+		while chunk := f.read(1024 * 1024):
+			digest.update(chunk)
+
+	return digest.hexdigest()
+
+# On disk cache of file content hashes, keyed by inode, so that hardlinks to the same file share an entry
+# A cached hash is only trusted while the file's size and mtime are unchanged. rsync and our own copies replace changed
+# files with new inodes, so unchanged files never need to be read again.
+class FileHashCache:
+	def __init__(self, filePath):
+		self.filePath = filePath
+		self.used = {}
+
+		try:
+			with open(filePath) as f:
+				self.data = json.load(f)
+		except FileNotFoundError:
+			self.data = {}
+
+	def hash(self, filePath, stat = None):
+		if stat is None:
+			stat = os.stat(filePath)
+
+		key = f"{stat.st_dev}:{stat.st_ino}"
+		entry = self.data.get(key)
+
+		if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+			digest = entry[2]
+		else:
+			digest = hashFile(filePath)
+
+		self.remember(stat, digest)
+		return digest
+
+	# Record the hash of a file whose contents are already known, e.g. one that was just copied
+	def remember(self, stat, digest):
+		self.used[f"{stat.st_dev}:{stat.st_ino}"] = [stat.st_size, stat.st_mtime_ns, digest]
+
+	# Only entries that were used since loading are kept, so files that no longer exist drop out
+	def save(self):
+		os.makedirs(os.path.dirname(self.filePath) or ".", exist_ok = True)
+		tempPath = self.filePath + ".tmp"
+
+		with open(tempPath, "w") as f:
+			json.dump(self.used, f)
+
+		os.replace(tempPath, self.filePath)
+
+# Manifest of everything in a dir tree, keyed by path relative to dirPath
+# Values are ["file", size, hash], ["link", target] or ["dir"]
+def buildManifest(dirPath, hashCache, exclude = [], relDir = "", manifest = None):
+	if manifest is None:
+		manifest = {}
+
+	for dirent in os.scandir(dirPath):
+		relPath = relDir + dirent.name
+
+		if relPath in exclude:
+			continue
+
+		if dirent.is_symlink():
+			manifest[relPath] = ["link", os.readlink(dirent.path)]
+		elif dirent.is_dir():
+			manifest[relPath] = ["dir"]
+			buildManifest(dirent.path, hashCache, exclude, relPath + "/", manifest)
+		elif dirent.is_file():
+			fileStat = dirent.stat()
+			manifest[relPath] = ["file", fileStat.st_size, hashCache.hash(dirent.path, fileStat)]
+
+	return manifest
+
+# Returns (changed, deleted) relative paths, going from oldManifest to newManifest
+# Deleted paths inside a deleted dir are omitted, as deleting the dir deletes them.
+def diffManifests(oldManifest, newManifest):
+	changed = sorted([relPath for relPath, entry in newManifest.items() if oldManifest.get(relPath) != entry])
+	deleted = sorted([relPath for relPath in oldManifest if relPath not in newManifest])
+	deletedDirs = set([relPath for relPath in deleted if oldManifest[relPath] == ["dir"]])
+	deleted = [relPath for relPath in deleted if os.path.dirname(relPath) not in deletedDirs]
+	return changed, deleted
+
+def removePath(path):
+	if os.path.isdir(path) and not os.path.islink(path):
+		shutil.rmtree(path)
+	elif os.path.lexists(path):
+		os.remove(path)
+
+# Sync sourceDir to destDir, like rsync --delete, using manifests of both sides
+# Only files whose inode, size or mtime changed since they were last hashed are read, and only files whose content
+# changed are copied.
+def localSync(sourceDir, destDir, hashCache):
+	os.makedirs(destDir, exist_ok = True)
+	sourceManifest = buildManifest(sourceDir, hashCache)
+	changed, deleted = diffManifests(buildManifest(destDir, hashCache), sourceManifest)
+
+	for relPath in deleted:
+		removePath(destDir + "/" + relPath)
+
+	# Sorted, so dirs are created before their contents
+	for relPath in changed:
+		entry = sourceManifest[relPath]
+		destPath = destDir + "/" + relPath
+
+		if entry[0] == "dir":
+			if not os.path.isdir(destPath) or os.path.islink(destPath):
+				removePath(destPath)
+				os.mkdir(destPath)
+			continue
+
+		if os.path.isdir(destPath) and not os.path.islink(destPath):
+			shutil.rmtree(destPath)
+
+		# Written to a new inode and renamed into place, so cached hashes of the old file can't be reused
+		tempPath = destPath + ".appcontrol-tmp"
+
+		if entry[0] == "link":
+			os.symlink(entry[1], tempPath)
+			os.replace(tempPath, destPath)
+		else:
+			# with permissions, e.g. for the control key
+			fastCopyFile(sourceDir + "/" + relPath, tempPath)
+			shutil.copymode(sourceDir + "/" + relPath, tempPath)
+			os.replace(tempPath, destPath)
+			hashCache.remember(os.stat(destPath), entry[2])
+
+	return changed, deleted
@@ -0,0 +1,4 @@
+import os, sys
+
+# The remote scripts aren't a package, they import each other from their own dir as they do when run on a server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "remote-scripts"))
@@ -0,0 +1,88 @@
+import os, errno, shutil, pytest
+import file_store
+from file_store import FileStore
+
+def writeFile(filePath, content, mode = 0o644):
+	os.makedirs(os.path.dirname(filePath), exist_ok = True)
+	
+	with open(filePath, "w") as f:
+		f.write(content)
+	
+	os.chmod(filePath, mode)
+
+@pytest.fixture
+def app(tmp_path):
+	writeFile(f"{tmp_path}/app/index.js", "index")
+	writeFile(f"{tmp_path}/app/lib/util.js", "util")
+	writeFile(f"{tmp_path}/app/lib/same.js", "index")
+	writeFile(f"{tmp_path}/app/run.sh", "run", 0o755)
+	os.symlink("index.js", f"{tmp_path}/app/link.js")
+	return f"{tmp_path}/app"
+
+@pytest.fixture
+def fileStore(tmp_path):
+	return FileStore(f"{tmp_path}/store", f"{tmp_path}/hashes.json")
+
+def getStoreFiles(fileStore):
+	return [
+		fileDirent.path for dirent in os.scandir(fileStore.storeDir) for fileDirent in os.scandir(dirent.path)
+	]
+
+def testInstallTree(tmp_path, app, fileStore):
+	fileStore.installTree(app, f"{tmp_path}/installed/app")
+	installed = f"{tmp_path}/installed/app"
+	
+	assert open(installed + "/lib/util.js").read() == "util"
+	assert os.stat(installed + "/run.sh").st_mode & 0o777 == 0o755
+	assert os.readlink(installed + "/link.js") == "index.js"
+	
+	# Identical files are stored once, and linked from the store
+	assert os.stat(installed + "/index.js").st_ino == os.stat(installed + "/lib/same.js").st_ino
+	assert len(getStoreFiles(fileStore)) == 3
+	assert fileStore.addedCount == 3
+	assert fileStore.linkedCount == 4
+
+def testTreeHash(tmp_path, app, fileStore):
+	treeHash = fileStore.installTree(app, f"{tmp_path}/installed/1")
+	assert fileStore.installTree(app, f"{tmp_path}/installed/2") == treeHash
+	
+	os.chmod(app + "/index.js", 0o600)
+	modeHash = fileStore.installTree(app, f"{tmp_path}/installed/3")
+	assert modeHash != treeHash
+	
+	writeFile(app + "/index.js", "changed", 0o600)
+	assert fileStore.installTree(app, f"{tmp_path}/installed/4") not in [treeHash, modeHash]
+
+# Where a file can't be linked from the store (e.g. it's on another filesystem), it's copied
+def testLinkFallback(tmp_path, app, fileStore, monkeypatch):
+	link = os.link
+	
+	def linkOnlyInStore(sourcePath, destPath):
+		if not destPath.startswith(fileStore.storeDir + "/"):
+			raise OSError(errno.EXDEV, "Invalid cross-device link")
+		
+		link(sourcePath, destPath)
+	
+	monkeypatch.setattr(file_store.os, "link", linkOnlyInStore)
+	fileStore.installTree(app, f"{tmp_path}/installed/app")
+	installed = f"{tmp_path}/installed/app"
+	
+	assert open(installed + "/index.js").read() == "index"
+	assert os.stat(installed + "/run.sh").st_mode & 0o777 == 0o755
+	assert os.stat(installed + "/index.js").st_nlink == 1
+	assert fileStore.linkedCount == 0
+
+def testPurgeUnused(tmp_path, app, fileStore):
+	fileStore.installTree(app, f"{tmp_path}/installed/1")
+	writeFile(app + "/lib/util.js", "changed")
+	fileStore.installTree(app, f"{tmp_path}/installed/2")
+	assert len(getStoreFiles(fileStore)) == 4
+	
+	# Nothing is purged while still installed, except leftover temp files
+	writeFile(fileStore.storeDir + "/ab/leftover.tmp", "")
+	assert fileStore.purgeUnused() == 1
+	assert len(getStoreFiles(fileStore)) == 4
+	
+	shutil.rmtree(f"{tmp_path}/installed/1")
+	assert fileStore.purgeUnused() == 1
+	assert sorted(open(storePath).read() for storePath in getStoreFiles(fileStore)) == ["changed", "index", "run"]
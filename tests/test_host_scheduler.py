@@ -0,0 +1,103 @@
+import asyncio, pytest
+import constants
+from host_scheduler import HostScheduler
+from errors import HostOperationError
+
+@pytest.fixture
+def scheduler(monkeypatch):
+	monkeypatch.setattr(constants, "HOST_OPERATION_BACKOFF_BASE", 0.01)
+	monkeypatch.setattr(constants, "HOST_OPERATION_BACKOFF_MAX", 0.04)
+	scheduler = HostScheduler()
+	scheduler.configure(attempts = 3, timeout = 5, deployTimeout = 60)
+	return scheduler
+
+# An operation that fails with each of failures in turn, then returns "done"
+def failingOperation(failures):
+	calls = []
+	
+	async def operation():
+		calls.append(len(calls))
+		
+		if len(calls) <= len(failures):
+			raise failures[len(calls) - 1]
+		
+		return "done"
+	
+	return operation, calls
+
+def testRetriedUntilSuccess(scheduler):
+	operation, calls = failingOperation([OSError("refused"), OSError("refused")])
+	assert asyncio.run(scheduler.run("host", "op", operation)) == "done"
+	assert len(calls) == 3
+	assert scheduler.results["host"]["succeeded"] == 1
+	assert scheduler.results["host"]["retries"] == 2
+	assert scheduler.results["host"]["failed"] == 0
+
+def testGivesUpAfterAttempts(scheduler):
+	operation, calls = failingOperation([OSError("refused")] * 5)
+	
+	with pytest.raises(HostOperationError, match = "op on host host failed after 3 attempts: refused"):
+		asyncio.run(scheduler.run("host", "op", operation))
+	
+	assert len(calls) == 3
+	assert scheduler.results["host"]["failed"] == 1
+	assert "refused" in scheduler.results["host"]["lastError"]
+
+def testOnlyRetriesRetryOn(scheduler):
+	operation, calls = failingOperation([ValueError("bad")])
+	
+	with pytest.raises(ValueError):
+		asyncio.run(scheduler.run("host", "op", operation, retryOn = (OSError,)))
+	
+	assert len(calls) == 1
+	assert scheduler.results["host"]["retries"] == 0
+
+# An attempt that times out isn't retried, as it may well take as long again
+def testTimeoutNotRetried(scheduler):
+	calls = []
+	
+	async def operation():
+		calls.append(True)
+		await asyncio.sleep(10)
+	
+	with pytest.raises(HostOperationError, match = "timed out"):
+		asyncio.run(scheduler.run("host", "op", operation, timeout = 0.05))
+	
+	assert len(calls) == 1
+
+def testNotStartedAfterDeadline(scheduler):
+	scheduler.configure(deployTimeout = 0)
+	operation, calls = failingOperation([])
+	
+	with pytest.raises(HostOperationError, match = "deadline has passed"):
+		asyncio.run(scheduler.run("host", "op", operation))
+	
+	assert len(calls) == 0
+
+def testBackoff(scheduler):
+	for attempt, backoff in [(1, 0.01), (2, 0.02), (3, 0.04), (10, 0.04)]:
+		for i in range(20):
+			assert backoff / 2 <= scheduler.getBackoff(attempt) <= backoff
+
+def testPerHostConcurrency(scheduler):
+	scheduler.configure(perHostConcurrency = 2, concurrency = 3)
+	running = {"a" : 0, "b" : 0}
+	maxRunning = {"a" : 0, "b" : 0, "total" : 0}
+	
+	async def operation(host):
+		running[host] += 1
+		maxRunning[host] = max(maxRunning[host], running[host])
+		maxRunning["total"] = max(maxRunning["total"], running["a"] + running["b"])
+		await asyncio.sleep(0.01)
+		running[host] -= 1
+	
+	async def runAll():
+		await asyncio.gather(*[scheduler.run(host, "op", lambda host = host: operation(host)) for host in ["a", "b"] * 5])
+	
+	asyncio.run(runAll())
+	assert maxRunning == {"a" : 2, "b" : 2, "total" : 3}
+
+def testConfigureFromConfig(scheduler):
+	scheduler.configureFromConfig({"attempts" : 2, "unknown" : 1})
+	assert scheduler.attempts == 2
+	assert scheduler.timeout == constants.HOST_OPERATION_TIMEOUT
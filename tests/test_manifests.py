@@ -0,0 +1,81 @@
+import os
+from utils import FileHashCache, buildManifest, diffManifests, hashFile
+
+def writeFile(filePath, content):
+	os.makedirs(os.path.dirname(filePath), exist_ok = True)
+	
+	with open(filePath, "w") as f:
+		f.write(content)
+
+def testBuildManifest(tmp_path):
+	writeFile(f"{tmp_path}/a.txt", "a")
+	writeFile(f"{tmp_path}/dir/b.txt", "bb")
+	os.symlink("a.txt", f"{tmp_path}/link")
+	writeFile(f"{tmp_path}/excluded.json", "{}")
+	manifest = buildManifest(str(tmp_path), FileHashCache(f"{tmp_path}/../hashes.json"), exclude = ["excluded.json"])
+	
+	assert manifest == {
+		"a.txt" : ["file", 1, hashFile(f"{tmp_path}/a.txt")],
+		"dir" : ["dir"],
+		"dir/b.txt" : ["file", 2, hashFile(f"{tmp_path}/dir/b.txt")],
+		"link" : ["link", "a.txt"]
+	}
+
+def testDiffChangedAndNew():
+	oldManifest = {"a" : ["file", 1, "h1"], "b" : ["file", 1, "h2"]}
+	newManifest = {"a" : ["file", 1, "h1"], "b" : ["file", 1, "h3"], "c" : ["file", 1, "h4"]}
+	assert diffManifests(oldManifest, newManifest) == (["b", "c"], [])
+
+def testDiffTypeChanges():
+	oldManifest = {"a" : ["file", 1, "h1"], "b" : ["dir"], "c" : ["link", "a"]}
+	newManifest = {"a" : ["dir"], "b" : ["link", "a"], "c" : ["file", 1, "h1"]}
+	assert diffManifests(oldManifest, newManifest) == (["a", "b", "c"], [])
+
+def testDiffDeletions():
+	oldManifest = {"a" : ["file", 1, "h1"], "b" : ["link", "a"], "c" : ["file", 1, "h2"]}
+	assert diffManifests(oldManifest, {"c" : ["file", 1, "h2"]}) == ([], ["a", "b"])
+
+# Paths inside a deleted dir go with it, but not those of a dir that's still there
+def testDiffDeletedDirs():
+	oldManifest = {
+		"dir" : ["dir"], "dir/a" : ["file", 1, "h1"], "dir/sub" : ["dir"], "dir/sub/b" : ["file", 1, "h2"],
+		"kept" : ["dir"], "kept/c" : ["file", 1, "h3"]
+	}
+	assert diffManifests(oldManifest, {"kept" : ["dir"]}) == ([], ["dir", "kept/c"])
+
+def testDiffUnchanged():
+	manifest = {"dir" : ["dir"], "dir/a" : ["file", 1, "h1"]}
+	assert diffManifests(manifest, dict(manifest)) == ([], [])
+
+def testHashCacheReusesUnchangedFiles(tmp_path):
+	filePath = f"{tmp_path}/a.txt"
+	writeFile(filePath, "a")
+	hashCache = FileHashCache(f"{tmp_path}/cache/hashes.json")
+	digest = hashCache.hash(filePath)
+	hashCache.save()
+	
+	# A cached hash is trusted while size and mtime are the same, even though the content isn't read again
+	fileStat = os.stat(filePath)
+	
+	with open(filePath, "r+") as f:
+		f.write("b")
+	
+	os.utime(filePath, ns = (fileStat.st_atime_ns, fileStat.st_mtime_ns))
+	assert FileHashCache(f"{tmp_path}/cache/hashes.json").hash(filePath) == digest
+	
+	# But not once the mtime changes
+	os.utime(filePath, ns = (fileStat.st_atime_ns, fileStat.st_mtime_ns + 1000))
+	assert FileHashCache(f"{tmp_path}/cache/hashes.json").hash(filePath) == hashFile(filePath) != digest
+
+def testHashCacheOnlyKeepsUsedEntries(tmp_path):
+	writeFile(f"{tmp_path}/a.txt", "a")
+	writeFile(f"{tmp_path}/b.txt", "b")
+	hashCache = FileHashCache(f"{tmp_path}/hashes.json")
+	hashCache.hash(f"{tmp_path}/a.txt")
+	hashCache.hash(f"{tmp_path}/b.txt")
+	hashCache.save()
+	
+	hashCache = FileHashCache(f"{tmp_path}/hashes.json")
+	hashCache.hash(f"{tmp_path}/a.txt")
+	hashCache.save()
+	assert len(FileHashCache(f"{tmp_path}/hashes.json").data) == 1
@@ -0,0 +1,36 @@
+import os, pytest
+import constants, host_utils
+from host_utils import fromTemplate
+from errors import TemplateError
+
+@pytest.fixture
+def templatesDir(tmp_path, monkeypatch):
+	os.makedirs(f"{tmp_path}/templates")
+	
+	with open(f"{tmp_path}/templates/test.template", "w") as f:
+		f.write("server ###NAME### {\n\tlisten ###PORT###;\n\talias ###NAME###;\n}\n")
+	
+	monkeypatch.setattr(constants, "HOSTSERVER_SCRIPTS_DIR", str(tmp_path))
+	monkeypatch.setattr(host_utils, "compiledTemplates", {})
+	return f"{tmp_path}/templates"
+
+def testRender(templatesDir):
+	assert fromTemplate("test.template", {"###NAME###" : "a", "###PORT###" : "80"}) == "server a {\n\tlisten 80;\n\talias a;\n}\n"
+
+# Substituted text is never itself substituted
+def testSinglePass(templatesDir):
+	rendered = fromTemplate("test.template", {"###NAME###" : "###PORT###", "###PORT###" : "80"})
+	assert rendered == "server ###PORT### {\n\tlisten 80;\n\talias ###PORT###;\n}\n"
+
+def testMissingPlaceholder(templatesDir):
+	with pytest.raises(TemplateError, match = r"missing placeholders \['###PORT###'\] and unknown placeholders \[\]"):
+		fromTemplate("test.template", {"###NAME###" : "a"})
+
+def testUnknownPlaceholder(templatesDir):
+	with pytest.raises(TemplateError, match = r"missing placeholders \[\] and unknown placeholders \['###OTHER###'\]"):
+		fromTemplate("test.template", {"###NAME###" : "a", "###PORT###" : "80", "###OTHER###" : ""})
+
+def testCompiledOnce(templatesDir):
+	fromTemplate("test.template", {"###NAME###" : "a", "###PORT###" : "80"})
+	os.remove(templatesDir + "/test.template")
+	assert fromTemplate("test.template", {"###NAME###" : "b", "###PORT###" : "81"}).startswith("server b {")
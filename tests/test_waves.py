@@ -0,0 +1,32 @@
+import pytest
+
+# control_utils needs asyncssh, as on the control server
+pytest.importorskip("asyncssh")
+from control_utils import splitIntoWaves
+
+HOSTS = ["host" + str(i) for i in range(10)]
+
+def testFixedSizes():
+	assert splitIntoWaves(HOSTS, [1, 3, 6]) == [HOSTS[:1], HOSTS[1:4], HOSTS[4:]]
+
+def testPercentagesOfAllHosts():
+	assert splitIntoWaves(HOSTS, ["20%", "50%"]) == [HOSTS[:2], HOSTS[2:7], HOSTS[7:]]
+
+def testPercentagesRoundUp():
+	assert [len(wave) for wave in splitIntoWaves(HOSTS, ["25%"])] == [3, 3, 3, 1]
+	assert [len(wave) for wave in splitIntoWaves(HOSTS, ["1%", "100%"])] == [1, 9]
+
+def testRemainingHostsInWavesOfTheLastSize():
+	assert [len(wave) for wave in splitIntoWaves(HOSTS, [1, 4])] == [1, 4, 4, 1]
+
+# Every wave has at least one host, and there are no empty waves after the hosts run out
+def testNoEmptyWaves():
+	assert splitIntoWaves(HOSTS[:2], [0, "0%", 5, 5]) == [HOSTS[:1], HOSTS[1:2]]
+	assert splitIntoWaves([], [1, "50%"]) == []
+
+def testDuplicateHostsOnlyOnce():
+	assert splitIntoWaves(["a", "b", "a", "c"], [2]) == [["a", "b"], ["c"]]
+
+def testNeedsAWave():
+	with pytest.raises(AssertionError):
+		splitIntoWaves(HOSTS, [])